@@ -7,18 +7,23 @@ warnings.filterwarnings("ignore", message="numpy.dtype size changed")
 warnings.filterwarnings("ignore", message="numpy.ufunc size changed")
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
+import json
 import time
 import signal
 import logging
 import logging.config
 import configargparse
 from datetime import datetime
-import h5py
 import numpy as np
 from mpi4py import MPI
+from scipy.stats import spearmanr
 
 # own modules
-from util.bswfocus import BSWFocus
+from util.bswfocus import BSWFocus, FDFDFocus
+from util.cache import ResultCache
+from util.journal import Journal
+from util.design import Design
+from util import metrics
 
 
 # MPI tags (basically an enum)
@@ -29,6 +34,10 @@ class Tags(object):
     START = 3
     WAIT = 4
     CONTINUE = 5
+    ADJOINT = 6
+    SCREEN = 7
+    UPDATE = 8
+    CANCEL = 9
 
 
 class BSWOpt(object):
@@ -55,6 +64,83 @@ class BSWOpt(object):
         self.tstamp = datetime.strftime(datetime.now(), '%Y%m%d-%H%M%S')
         self.infile = config.infile
         self.loss = config.loss
+        self.adjoint_k = config.adjoint_k
+        self.lazy = config.lazy
+        self.lazy_refresh = config.lazy_refresh
+        self.batch_k = config.batch_k
+        self.batch_dist = config.batch_dist
+        self.pipeline = config.pipeline
+        if self.pipeline and (self.adjoint_k or self.batch_k > 1 or config.screen_res or self.lazy):
+            self.logger.warning("Pipelining is only used without adjoint_k, batch_k, screen_res and lazy.")
+            self.pipeline = False
+        # accepted flips per iteration and the number of iterations each slave's design includes
+        self.history = []
+        self.version = {rank: 0 for rank in range(1, self.size)}
+        # pipelining state, running tasks per slave as (iteration, candidate, assumed leader, flips sent),
+        # speculative results as candidate: (loss, metric vector)
+        self.running = {}
+        self.waitlist = []
+        self.acked = set()
+        self.spec_leader = None
+        self.spec_results = {}
+        self.task = None
+        # fault tolerance, deadline per busy slave and slaves that missed theirs
+        self.task_timeout = config.task_timeout
+        self.timeout_factor = config.timeout_factor
+        self.max_retries = config.max_retries
+        self.deadlines = {}
+        self.dead = set()
+        self.duplicates = config.duplicates
+        # checkpointing, loop state of the current iteration and the results finished so far
+        self.checkpoint_interval = config.checkpoint_interval
+        self.last_checkpoint = time.time()
+        self.state = None
+        self.partial = {}
+        self.fname = None
+        self.journal = None
+        # wall time and time steps of the last evaluation per candidate, and per iteration
+        self.costs = {}
+        self.cost_list = []
+        # metric vectors of the candidates of the current iteration and per iteration
+        self.metrics = {}
+        self.metric_list = []
+        self.steps = 0
+        self.screen_res = config.screen_res
+        self.screen_k = config.screen_k
+        self.screen_k_min = config.screen_k
+        self.screen_margin = config.screen_margin
+        self.screen_ranks = []
+        self.screen_corr = []
+        self.matgrid = config.matgrid
+        self.backend = config.backend
+        # the fdfd backend differentiates its steady state solution, meep reads the design fields of two runs
+        meep_adjoint = self.adjoint_k and self.backend != 'fdfd'
+        if meep_adjoint and (config.solver != 'time' or config.dft == 'focus'):
+            # design field phasors come from complex time stepping or a DFT over the whole cell
+            self.logger.warning("The adjoint sensitivity needs --solver time and --dft none or cell, "
+                                "adjoint_k is not used.")
+            self.adjoint_k = 0
+        elif meep_adjoint and (config.monitor == 'extrapolate' or config.max_time > 0):
+            # only the focus region is extrapolated, and a time budget may stop before the design fields settle
+            self.logger.warning("The adjoint sensitivity needs design fields run to convergence, "
+                                "adjoint_k is not used with --monitor extrapolate or --max_time.")
+            self.adjoint_k = 0
+        self.cache = None if config.cache is None else ResultCache(config.cache, int(config.cache_size * 2**20))
+        # run control passed through to BSWFocus
+        self.sim_options = {
+            'use_material_grid': self.matgrid,
+            'monitor': config.monitor,
+            'monitor_interval': config.monitor_interval,
+            'monitor_rtol': config.monitor_rtol,
+            'max_time': config.max_time,
+            'solver': config.solver,
+            'cw_tol': config.cw_tol,
+            'cw_maxiters': config.cw_maxiters,
+            'dft_region': None if config.dft == 'none' else config.dft,
+            'auto_cell': config.auto_cell,
+            'cell_margin': config.cell_margin,
+        }
+        self.bsw = {}
 
     def start(self):
         if self.size < 2:
@@ -73,83 +159,89 @@ class BSWOpt(object):
     def master(self):
         self.logger.info("Using {} processes.".format(self.size))
 
+        state = {}
         if self.infile is None:
             fname = '{}{}_bsw_{}x{}_res{}.h5'.format(self.outputdir, self.tstamp, self.dim_x, self.dim_y, self.res)
             self.logger.info("No input file specified, creating {}.".format(fname))
-            field_list = [0]
+            field_list = [0.]
             max_field = 0
             M_list = []
-            Ml = np.zeros((int(self.dim_x / 2), self.dim_y))
+            Ml = np.zeros((int(self.dim_x / 2), self.dim_y), dtype=np.uint8)
             t = []
         else:
-            fname = infile
+            fname = self.infile
             self.logger.info("Using existing optimization {}.".format(fname))
-            h5f = h5py.File(fname, 'r')
-            field_list = list(h5f['focus'])
+            data = Journal.load(fname)
+            field_list = data['focus']
             max_field = field_list[-1]
-            t = list(h5f['it_time'])
-            M_list = list(h5f['design'])
-            Ml = M_list[-1][:int(M_list[-1].shape[0] / 2)]
-            h5f.close()
+            t = data['it_time']
+            M_list = [Design(m) for m in data['design']]
+            if data['state'] is not None:
+                state = self.read_state(data)
+                max_field = state['max_field']
+                Ml = state['Ml']
+                # the interrupted iteration is restarted
+                t = t[:-1]
+                self.logger.info("Resuming iteration {} with {} finished tasks.".format(
+                    state['iterations'] + 1, len(self.partial)))
+            else:
+                Ml = np.asarray(M_list[-1])[:int(M_list[-1].shape[0] / 2)]
+        self.fname = fname
+        self.journal = Journal(fname)
+        self.journal.sync('it_time', t)
+        sim = self.create_sim()
+        if sim.auto_cell:
+            self.logger.info("Cropped the cell to sy = {:.2f} around y = {:.2f}, {:.1%} less area.".format(
+                sim.sy, sim.cell_center.y, sim.cell_savings()))
+        self.journal.write_group('sim', sim.to_dict())
+        self.journal.write_group(None, {'metric_names': np.array(metrics.names(), dtype='S')})
 
         self.logger.debug("Initial matrix:\n{}".format(Ml))
+        Ml = np.ascontiguousarray(Ml, dtype=np.uint8)
+        design = Design(Ml)
+        self.comm.bcast(design.shape, root=0)
+        self.comm.Bcast(design.bits, root=0)
 
         # optimization control
         margin = 2
-        margin_counter = 0
-        Ml_bak = None
-        first_neg = True
-        iterations = 0
+        margin_counter = state.get('margin_counter', 0)
+        Ml_bak = state.get('Ml_bak')
+        first_neg = state.get('first_neg', True)
+        iterations = state.get('iterations', 0)
+        scores = state.get('scores', {})
 
         while True:
-            tasks = []
-            for i1, i2 in np.transpose(np.where(Ml == 0)):
-                tMl = np.copy(Ml)
-                tMl[i1, i2] = 1
-                tM = np.vstack((tMl, np.flipud(tMl)))
-                tasks.append((i1, i2, tM))
-            res_fields = []
-            res_idx = []
-            waitlist = []
-            total_tasks = len(tasks)
-            distributed_tasks = 0
             t.append(time.time())
-
-            while True:
-                self.logger.debug("Receiving...")
-                self.status = MPI.Status()
-                data = self.comm.recv(source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG, status=self.status)
-                source = self.status.Get_source()
-                tag = self.status.Get_tag()
-
-                if tag == Tags.DONE:
-                    self.logger.debug("Received DONE from slave {}.".format(source))
-                    res_idx.append((data[0], data[1]))
-                    res_fields.append(data[2])
-                elif tag == Tags.READY:
-                    self.logger.debug("Received READY from slave {}.".format(source))
-                    if not tasks or distributed_tasks == total_tasks:
-                        self.logger.debug("Send WAIT to slave {}.".format(source))
-                        self.comm.send(None, dest=source, tag=Tags.WAIT)
-                        waitlist.append(source)
-                    else:
-                        self.logger.debug("Send START to slave {}.".format(source))
-                        self.comm.send(tasks.pop(), dest=source, tag=Tags.START)
-                        distributed_tasks += 1
-                if tag == Tags.WAIT:
-                    self.logger.debug("Received WAIT from slave {}.".format(source))
-                    if len(waitlist) == self.size - 1:
-                        break
-
-            res_idx = np.array(res_idx)
-            res_fields = np.array(res_fields)
+            self.state = {'Ml': np.copy(Ml), 'Ml_bak': Ml_bak, 'max_field': max_field, 'margin_counter': margin_counter,
+                          'first_neg': first_neg, 'iterations': iterations, 'scores': scores,
+                          'M_list': M_list, 'field_list': field_list, 't': t}
+            self.checkpoint(force=iterations > 0 and iterations % 10 == 0)
+            candidates = np.transpose(np.where(Ml == 0))
+            if self.adjoint_k and len(candidates) > self.adjoint_k:
+                candidates = self.rank_candidates(Ml, candidates)
+            if self.pipeline:
+                results, waitlist = self.pipeline_distribute(Ml, candidates, scores)
+            elif self.screen_res:
+                results, waitlist = self.screen(Ml, candidates)
+            elif self.lazy and scores and iterations % self.lazy_refresh:
+                results, waitlist = self.lazy_distribute(Ml, candidates, scores)
+            else:
+                results, waitlist = self.distribute(list(candidates))
+            scores.update({(i, j): field for i, j, field in results})
+            self.cost_list.append(self.cost_matrix(Ml.shape, results))
+            self.metric_list.append(self.metric_matrix(Ml.shape, results))
+            res_idx = np.array([(i, j) for i, j, _ in results])
+            res_fields = np.array([field for _, _, field in results])
             if not res_idx.any() or not res_fields.any():
                 if margin_counter > 0:
                     Ml = Ml_bak
                 break
 
             field = res_fields[np.argmax(res_fields)]
-            idx = res_idx[np.argmax(res_fields)]
+            flips = [res_idx[np.argmax(res_fields)]]
+            if self.batch_k > 1 and field > max_field:
+                self.resume(waitlist)
+                flips, field = self.batch(res_idx, res_fields, max_field)
 
             iterations += 1
             self.logger.info("Iteration {:<6d}, dE = {}".format(iterations, field - max_field))
@@ -162,51 +254,535 @@ class BSWOpt(object):
             else:
                 max_field = field
                 field_list.append(max_field)
-                M_list.append(np.vstack((Ml, np.flipud(Ml))))
+                M_list.append(Design(Ml).mirrored())
                 margin_counter = 0
                 first_neg = True
 
             if margin_counter <= margin:
-                Ml[int(idx[0]), int(idx[1])] = 1
+                for idx in flips:
+                    Ml[int(idx[0]), int(idx[1])] = 1
             else:
                 Ml = Ml_bak
                 break
 
             self.logger.debug("Matrix after iteration {}:\n{}".format(iterations, Ml))
 
-            for rank in waitlist:
-                self.logger.debug("Send CONTINUE to slave {}.".format(rank))
-                self.comm.send(None, dest=rank, tag=Tags.CONTINUE)
-
-            if iterations % 10 == 0:
-                self.create_output(fname, np.array(M_list), np.array(field_list), np.array(t))
+            self.update(flips)
 
         # let slaves exit gracefully
+        if self.pipeline:
+            self.settle()
         for rank in range(1, self.size):
+            if rank in self.dead:
+                continue
             self.logger.debug("Send STOP to slave {}.".format(rank))
-            self.comm.send(None, dest=rank, tag=Tags.STOP)
-            self.comm.recv(None, source=rank, tag=Tags.STOP)
+            self.send((), dest=rank, tag=Tags.STOP)
+            self.recv(source=rank, tag=Tags.STOP)
 
         self.logger.info("Optimization finished in {} iterations.".format(iterations))
-        self.create_output(fname, np.array(M_list), np.array(field_list), np.array(t))
+        self.state = None
+        self.create_output(M_list, field_list, t)
+        self.journal.close()
+        if self.dead:
+            # unresponsive slaves would block MPI.Finalize
+            self.logger.warning("Aborting unresponsive slaves {}.".format(sorted(self.dead)))
+            self.comm.Abort(1)
+
+    def batch(self, res_idx, res_fields, max_field):
+        """Selects up to batch_k improving flips that are at least batch_dist pixels apart and
+        simulates the combined designs of the best 2, 3, ... of them in parallel.
+        Returns the flips of the best combination, or the single best flip if no combination beats it.
+        """
+        order = np.argsort(res_fields)[::-1]
+        selected = []
+        for n in order:
+            if res_fields[n] <= max_field or len(selected) == self.batch_k:
+                break
+            if all(self.distance(res_idx[n], res_idx[m]) >= self.batch_dist for m in selected):
+                selected.append(n)
+        flips, field = [res_idx[selected[0]]], res_fields[selected[0]]
+        if len(selected) < 2:
+            return flips, field
+
+        # the last flip of each combination comes first in its task and identifies it in the results
+        tasks = [res_idx[selected[n - 1::-1]].ravel() for n in range(2, len(selected) + 1)]
+        last = {tuple(res_idx[selected[n - 1]]): n for n in range(2, len(selected) + 1)}
+        results, waitlist = self.distribute(tasks)
+        for i, j, combined in results:
+            if combined > field:
+                flips, field = list(res_idx[selected[:last[(i, j)]]]), combined
+        self.logger.info("Accepting {} of {} flips in one iteration.".format(len(flips), len(selected)))
+        return flips, field
+
+    def distance(self, a, b):
+        """Chebyshev distance between two pixels of the design half, or pixel a and the mirror image of b"""
+        dx = min(abs(a[0] - b[0]), self.dim_x - 1 - a[0] - b[0])
+        return max(dx, abs(a[1] - b[1]))
+
+    def lazy_distribute(self, Ml, candidates, scores):
+        """Re-simulates candidates in order of their scores from earlier iterations, one batch
+        per slave, until the best new score beats the old score of every remaining candidate.
+        Candidates without a score are simulated first.
+        """
+        stale = np.array([scores.get((i1, i2), np.inf) for i1, i2 in candidates])
+        order = np.argsort(-stale, kind='stable')
+        candidates, stale = candidates[order], stale[order]
+        batch = self.size - 1
+        results = []
+        start = 0
+        while True:
+            new_results, waitlist = self.distribute(list(candidates[start:start + batch]))
+            results += new_results
+            start += batch
+            if start >= len(candidates):
+                break
+            # without results so far, all tasks were dropped and the next batch is tried
+            if results and max(field for _, _, field in results) >= stale[start]:
+                break
+            self.resume(waitlist)
+        self.logger.info("Lazy evaluation of {} of {} candidates.".format(len(results), len(candidates)))
+        return results, waitlist
+
+    def screen(self, Ml, candidates):
+        """Simulates all candidates at the screening resolution and only the best screen_k of them,
+        or all within screen_margin of the best, at the full resolution.
+        screen_k adapts to how far down the coarse ranking the recent fine winners were found.
+        """
+        if not len(candidates):
+            return self.distribute([])
+        coarse, waitlist = self.distribute(list(candidates), tag=Tags.SCREEN)
+        self.resume(waitlist)
+        if not coarse:
+            self.logger.warning("No candidate returned from screening, simulating all at full resolution.")
+            return self.distribute(list(candidates))
+        coarse.sort(key=lambda r: r[2], reverse=True)
+        coarse_fields = np.array([field for _, _, field in coarse])
+        within = np.sum(coarse_fields >= coarse_fields[0] - self.screen_margin * np.abs(coarse_fields[0]))
+        k = max(self.screen_k, within)
+        selected = np.array([(i, j) for i, j, _ in coarse[:k]])
+        results, waitlist = self.distribute(list(selected))
+
+        # rank agreement between the two fidelities, of the candidates not dropped after max_retries
+        fine = {(i, j): field for i, j, field in results}
+        returned = [n for n, (i, j) in enumerate(selected) if (i, j) in fine]
+        if not returned:
+            return results, waitlist
+        fine_fields = np.array([fine[tuple(selected[n])] for n in returned])
+        rank = returned[int(np.argmax(fine_fields))]
+        corr = spearmanr(coarse_fields[returned], fine_fields)[0] if len(returned) > 2 else 1.
+        self.screen_ranks.append(rank)
+        self.screen_corr.append(corr)
+        self.logger.info("Screening: fine winner at coarse rank {} of {}, rank correlation {:.3f}.".format(
+            rank + 1, len(selected), corr))
+
+        # keep twice the worst recent winner rank in the fine stage
+        self.screen_k = int(np.clip(2 * (max(self.screen_ranks[-5:]) + 1), self.screen_k_min, len(candidates)))
+        self.logger.debug("Screening with k = {}.".format(self.screen_k))
+        return results, waitlist
+
+    def distribute(self, tasks, tag=Tags.START):
+        """Hands out tasks until every live slave is waiting, returns the collected results.
+        Tasks of slaves that miss their deadline or fail are re-queued up to max_retries times.
+        With duplicates, slaves without a task run a copy of the longest running task,
+        the copy finishing last is cancelled.
+        """
+        results = []
+        waitlist = []
+        acked = set()
+        assigned = {}
+        started = {}
+        retries = {}
+        tasks = self.by_cost(tasks)
+        # results of this iteration from before a restart
+        results += [tuple(self.partial[self.task_key(task, tag)]) for task in tasks
+                    if self.task_key(task, tag) in self.partial]
+        tasks = [task for task in tasks if self.task_key(task, tag) not in self.partial]
+
+        while len(acked) < self.size - 1 - len(self.dead):
+            self.logger.debug("Receiving...")
+            data, late = self.receive()
+            for rank in late:
+                task = assigned.pop(rank)
+                if task is not None and not self.copies(assigned, task):
+                    self.retry(task, tasks, retries)
+            if tasks and waitlist:
+                # a waiting slave takes over the re-queued tasks
+                rank = waitlist.pop()
+                acked.discard(rank)
+                self.resume([rank])
+            if data is None:
+                continue
+            source = self.status.Get_source()
+            tag_in = self.status.Get_tag()
+
+            if tag_in == Tags.DONE:
+                self.logger.debug("Received DONE from slave {}.".format(source))
+                task = assigned.pop(source, None)
+                self.deadlines.pop(source, None)
+                if task is None:
+                    # cancelled copy, or late result of a slave that missed its deadline
+                    continue
+                copies = self.copies(assigned, task)
+                failed = np.all(np.isnan(data)) if tag == Tags.ADJOINT else np.isnan(data[2])
+                if failed:
+                    if not copies:
+                        self.retry(task, tasks, retries)
+                    continue
+                for rank in copies:
+                    self.logger.debug("Send CANCEL to slave {}.".format(rank))
+                    self.send(task, dest=rank, tag=Tags.CANCEL, dtype=np.int32)
+                    assigned[rank] = None
+                if tag == Tags.ADJOINT:
+                    results.append((None, None, data.reshape((-1, self.dim_y))))
+                else:
+                    results.append((int(data[0]), int(data[1]), data[2]))
+                    # a combination of flips is keyed by the flip leading its task, it must not
+                    # replace the cost and metrics of that single candidate
+                    if tag == Tags.START and np.size(task) == 2:
+                        self.costs[(int(data[0]), int(data[1]))] = tuple(data[3:5])
+                        self.metrics[(int(data[0]), int(data[1]))] = tuple(data[5:])
+                    self.partial[self.task_key(task, tag)] = results[-1]
+                    self.checkpoint()
+            elif tag_in == Tags.READY:
+                self.logger.debug("Received READY from slave {}.".format(source))
+                if self.version[source] < len(self.history):
+                    self.wake(source)
+                elif tasks or (self.duplicates and self.straggler(assigned, started) is not None):
+                    if tasks:
+                        assigned[source] = tasks.pop()
+                    else:
+                        rank = self.straggler(assigned, started)
+                        self.logger.debug("Duplicating the task of slave {}.".format(rank))
+                        assigned[source] = assigned[rank]
+                    self.logger.debug("Send {} to slave {}.".format(tag, source))
+                    started[source] = time.time()
+                    self.deadlines[source] = started[source] + self.deadline(assigned[source], tag)
+                    self.send(assigned[source], dest=source, tag=tag, dtype=np.int32)
+                else:
+                    self.logger.debug("Send WAIT to slave {}.".format(source))
+                    self.send((), dest=source, tag=Tags.WAIT)
+                    waitlist.append(source)
+            elif tag_in == Tags.WAIT:
+                self.logger.debug("Received WAIT from slave {}.".format(source))
+                if source in waitlist:
+                    acked.add(source)
+        return results, waitlist
+
+    def copies(self, assigned, task):
+        """Slaves running the same task"""
+        return [rank for rank, other in assigned.items() if other is not None and np.array_equal(other, task)]
+
+    def straggler(self, assigned, started):
+        """Slave with the longest running task that has no copy yet, None if there is none"""
+        single = [rank for rank, task in assigned.items() if task is not None and len(self.copies(assigned, task)) == 1]
+        if not single:
+            return None
+        return min(single, key=started.get)
+
+    def receive(self):
+        """Waits for the next slave message.
+        Returns the message, or None and the slaves that missed their task deadline meanwhile.
+        Those are considered dead until they respond again.
+        """
+        while True:
+            now = time.time()
+            late = [rank for rank, deadline in self.deadlines.items() if deadline < now]
+            if late:
+                for rank in late:
+                    self.logger.warning("Slave {} missed its task deadline, continuing without it.".format(rank))
+                    del self.deadlines[rank]
+                    self.dead.add(rank)
+                return None, late
+            if self.comm.Iprobe(source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG):
+                data = self.recv(source=MPI.ANY_SOURCE)
+                source = self.status.Get_source()
+                if source in self.dead:
+                    self.logger.info("Slave {} responds again.".format(source))
+                    self.dead.discard(source)
+                return data, []
+            time.sleep(1e-3)
+
+    def deadline(self, task, tag=Tags.START):
+        """Seconds a task may take, at most task_timeout and timeout_factor times the longer
+        of its last and the median run time
+        """
+        limits = [np.inf]
+        if self.task_timeout:
+            limits.append(self.task_timeout)
+        if self.timeout_factor and self.costs and tag != Tags.ADJOINT:
+            median = np.median([cost[0] for cost in self.costs.values()])
+            limits.append(self.timeout_factor * max(self.costs.get(tuple(task[:2]), (median,))[0], median))
+        return min(limits)
+
+    def retry(self, task, tasks, retries):
+        """Re-queues a failed task, unless it already failed max_retries times"""
+        key = self.task_key(task)
+        retries[key] = retries.get(key, 0) + 1
+        if retries[key] > self.max_retries:
+            self.logger.warning("Dropping task {} after {} failures.".format(key, retries[key]))
+        else:
+            self.logger.warning("Re-queueing task {}.".format(key))
+            tasks.append(task)
+
+    def task_key(self, task, tag=None):
+        key = tuple(int(v) for v in np.ravel(task))
+        return key if tag is None else (int(tag),) + key
+
+    def by_cost(self, tasks):
+        """Sorts tasks so that pop() returns the longest running candidate of the last evaluation first.
+        Candidates without a recorded cost are handed out before all others.
+        """
+        return sorted(tasks, key=lambda task: self.costs.get(tuple(task[:2]), (np.inf,))[0])
+
+    def cost_matrix(self, shape, results):
+        """Wall time and time steps of the candidates in results, nan for all other pixels"""
+        cost = np.full((2,) + tuple(shape), np.nan)
+        for i, j, _ in results:
+            cost[:, int(i), int(j)] = self.costs.get((int(i), int(j)), np.nan)
+        return cost
+
+    def metric_matrix(self, shape, results):
+        """Metric vectors of the candidates in results, nan for all other pixels"""
+        values = np.full((len(metrics.names()),) + tuple(shape), np.nan)
+        for i, j, _ in results:
+            values[:, int(i), int(j)] = self.metrics.get((int(i), int(j)), np.nan)
+        return values
+
+    def resume(self, waitlist):
+        for rank in waitlist:
+            self.logger.debug("Send CONTINUE to slave {}.".format(rank))
+            self.send((), dest=rank, tag=Tags.CONTINUE)
+
+    def update(self, flips):
+        """Records the accepted flips, resumes all slaves with them unless pipelining"""
+        self.history.append([tuple(int(f) for f in idx) for idx in flips])
+        self.partial = {}
+        self.metrics = {}
+        if not self.pipeline:
+            for rank in range(1, self.size):
+                if rank not in self.dead:
+                    self.wake(rank)
+
+    def wake(self, rank):
+        """Answers a waiting slave with the flips accepted since its last update"""
+        flips = [idx for flips in self.history[self.version[rank]:] for idx in flips]
+        self.logger.debug("Send UPDATE to slave {}.".format(rank))
+        self.send(np.reshape(flips, -1), dest=rank, tag=Tags.UPDATE, dtype=np.int32)
+        self.version[rank] = len(self.history)
+        if rank in self.waitlist:
+            self.waitlist.remove(rank)
+            self.acked.discard(rank)
+
+    def pipeline_distribute(self, Ml, candidates, scores):
+        """Distributes the candidates without a barrier at the end of the iteration.
+        Once the unfinished candidates are bounded by their scores from earlier iterations,
+        idle slaves speculatively evaluate the next iteration assuming the current leader is accepted.
+        That work is adopted if the leader is accepted and cancelled otherwise.
+        """
+        iteration = len(self.history)
+        results = {}
+        if self.spec_leader is not None and self.history[-1] == [self.spec_leader]:
+            for c, (field, values) in self.spec_results.items():
+                results[c] = field
+                self.metrics[c] = values
+                self.partial[self.task_key(c, Tags.START)] = c + (field,)
+            for rank, task in self.running.items():
+                if task is not None and task[2] == self.spec_leader:
+                    # the slave still holds the flips it was sent, a CANCEL must repeat them
+                    self.running[rank] = (iteration, task[1], None, task[3])
+            self.logger.debug("Adopting {} speculative results.".format(len(results)))
+        self.cancel_speculation()
+        for rank in list(self.waitlist):
+            self.wake(rank)
+        for c in map(tuple, candidates):
+            if self.task_key(c, Tags.START) in self.partial:
+                results[c] = self.partial[self.task_key(c, Tags.START)][2]
+
+        busy = [task[1] for task in self.running.values() if task is not None]
+        todo = self.by_cost([c for c in map(tuple, candidates) if c not in results and c not in busy])
+        spec_todo = []
+        retries = {}
+        while todo or any(task is not None and task[2] is None for task in self.running.values()):
+            if len(self.dead) == self.size - 1:
+                self.logger.error("No responsive slaves left.")
+                break
+            data, late = self.receive()
+            for rank in late:
+                task = self.running.pop(rank, None)
+                if task is not None and task[2] is None:
+                    self.retry(task[1], todo, retries)
+            if todo and self.waitlist:
+                self.wake(self.waitlist[0])
+            if data is None:
+                continue
+            source = self.status.Get_source()
+            tag_in = self.status.Get_tag()
+
+            if tag_in == Tags.DONE:
+                self.logger.debug("Received DONE from slave {}.".format(source))
+                self.deadlines.pop(source, None)
+                task = self.running.pop(source, None)
+                if task is None:
+                    continue
+                self.costs[task[1]] = tuple(data[3:5])
+                if task[2] is None and np.isnan(data[2]):
+                    self.retry(task[1], todo, retries)
+                elif task[2] is None:
+                    results[task[1]] = data[2]
+                    self.metrics[task[1]] = tuple(data[5:])
+                    self.partial[self.task_key(task[1], Tags.START)] = task[1] + (data[2],)
+                    self.checkpoint()
+                elif task[2] == self.spec_leader and not np.isnan(data[2]):
+                    self.spec_results[task[1]] = (data[2], tuple(data[5:]))
+            elif tag_in == Tags.READY:
+                self.logger.debug("Received READY from slave {}.".format(source))
+                if self.version[source] < iteration:
+                    self.wake(source)
+                elif todo:
+                    c = todo.pop()
+                    self.running[source] = (iteration, c, None, np.ravel(c))
+                    self.send(self.running[source][3], dest=source, tag=Tags.START, dtype=np.int32)
+                    self.deadlines[source] = time.time() + self.deadline(c)
+                elif spec_todo:
+                    c = spec_todo.pop()
+                    # the candidate followed by the assumed leader
+                    self.running[source] = (iteration + 1, c, self.spec_leader, np.ravel([c, self.spec_leader]))
+                    self.send(self.running[source][3], dest=source, tag=Tags.START, dtype=np.int32)
+                    self.deadlines[source] = time.time() + self.deadline(c)
+                else:
+                    self.logger.debug("Send WAIT to slave {}.".format(source))
+                    self.send((), dest=source, tag=Tags.WAIT)
+                    self.waitlist.append(source)
+            elif tag_in == Tags.WAIT:
+                self.logger.debug("Received WAIT from slave {}.".format(source))
+                if source in self.waitlist:
+                    self.acked.add(source)
+
+            if not results:
+                continue
+            leader = max(results, key=results.get)
+            if self.spec_leader is not None and leader != self.spec_leader:
+                self.logger.debug("Leader changed, cancelling speculation on {}.".format(self.spec_leader))
+                self.cancel_speculation()
+                spec_todo = []
+            bounds = [scores.get(task[1], np.inf) for task in self.running.values()
+                      if task is not None and task[2] is None]
+            if self.spec_leader is None and not todo and all(b < results[leader] for b in bounds):
+                self.logger.debug("Speculating on leader {}.".format(leader))
+                self.spec_leader = leader
+                tMl = np.copy(Ml)
+                tMl[leader] = 1
+                spec_todo = self.by_cost(map(tuple, np.transpose(np.where(tMl == 0))))
+                for rank in list(self.waitlist):
+                    self.wake(rank)
+        return [(i, j, field) for (i, j), field in results.items()], list(self.waitlist)
+
+    def cancel_speculation(self):
+        for rank, task in self.running.items():
+            if task is not None and task[2] is not None:
+                self.logger.debug("Send CANCEL to slave {}.".format(rank))
+                self.send(task[3], dest=rank, tag=Tags.CANCEL, dtype=np.int32)
+                self.running[rank] = None
+        self.spec_leader = None
+        self.spec_results = {}
+
+    def settle(self):
+        """Cancels all running tasks and returns once every slave waits"""
+        for rank, task in self.running.items():
+            if task is not None:
+                self.send(task[3], dest=rank, tag=Tags.CANCEL, dtype=np.int32)
+                self.running[rank] = None
+        while len(self.acked) < self.size - 1 - len(self.dead):
+            data, late = self.receive()
+            for rank in late:
+                self.running.pop(rank, None)
+            if data is None:
+                continue
+            source = self.status.Get_source()
+            tag_in = self.status.Get_tag()
+            if tag_in == Tags.DONE:
+                self.deadlines.pop(source, None)
+                self.running.pop(source, None)
+            elif tag_in == Tags.READY:
+                self.send((), dest=source, tag=Tags.WAIT)
+                self.waitlist.append(source)
+            elif tag_in == Tags.WAIT and source in self.waitlist:
+                self.acked.add(source)
+
+    def cancelled(self):
+        """Polled by the simulation, true if the master cancelled the running task"""
+        if not self.comm.Iprobe(source=0, tag=Tags.CANCEL):
+            return False
+        data = self.recv(source=0, tag=Tags.CANCEL, dtype=np.int32)
+        return np.array_equal(data, self.task)
+
+    def send(self, data, dest, tag, dtype=np.float64):
+        self.comm.Send(np.ascontiguousarray(data, dtype=dtype), dest=dest, tag=tag)
+
+    def recv(self, source, tag=MPI.ANY_TAG, dtype=np.float64):
+        """Receives a message of any length into a new buffer"""
+        self.status = MPI.Status()
+        self.comm.Probe(source=source, tag=tag, status=self.status)
+        data = np.empty(self.status.Get_count(MPI.BYTE) // np.dtype(dtype).itemsize, dtype=dtype)
+        self.comm.Recv(data, source=self.status.Get_source(), tag=self.status.Get_tag())
+        return data
+
+    def rank_candidates(self, Ml, candidates):
+        """Keeps the adjoint_k candidates with the largest first-order focus intensity gain.
+        The sensitivity targets the box intensity and serves as a proxy for the other losses,
+        the selected candidates are verified with full simulations using the configured loss.
+        """
+        results, waitlist = self.distribute([()], tag=Tags.ADJOINT)
+        self.resume(waitlist)
+        if not results:
+            self.logger.warning("No adjoint sensitivity, evaluating all candidates.")
+            return candidates
+        sens = results[0][2]
+        half = int(sens.shape[0] / 2)
+        sens = sens[:half] + np.flipud(sens[half:])
+        order = np.argsort(sens[candidates[:, 0], candidates[:, 1]])[::-1]
+        self.logger.debug("Adjoint sensitivity:\n{}".format(sens))
+        return candidates[order[:self.adjoint_k]]
 
     def slave(self):
+        # the current design half is broadcast bit-packed by the master, tasks only carry the candidate index
+        shape = self.comm.bcast(None, root=0)
+        bits = np.empty((int(np.prod(shape)) + 7) // 8, dtype=np.uint8)
+        self.comm.Bcast(bits, root=0)
+        Ml = np.asarray(Design.from_bits(shape, bits))
         mystatus = Tags.READY
         while True:
             self.logger.debug("Send STATUS: {}.".format(mystatus))
-            self.comm.send(None, dest=0, tag=mystatus)
-            self.status = MPI.Status()
-            data = self.comm.recv(source=0, tag=MPI.ANY_TAG, status=self.status)
+            self.send((), dest=0, tag=mystatus)
+            data = self.recv(source=0, dtype=np.int32)
             tag = self.status.Get_tag()
+            while tag == Tags.CANCEL:
+                # the cancelled task finished before the cancellation arrived
+                data = self.recv(source=0, dtype=np.int32)
+                tag = self.status.Get_tag()
+            self.task = data
             if tag == Tags.START:
                 self.logger.debug("Received START.")
-                i, j, tM = data
-                bsw = self.create_sim(tM)
-                bsw.run()
-                loss = self.get_loss(bsw)
-                self.logger.debug("Loss: {}.".format(loss))
+                # one candidate or a combination of flips, (i, j) is the first pixel
+                i, j = data[:2]
+                result = self.run_task(i, j, self.candidate(Ml, data.reshape((-1, 2))))
+                self.logger.debug("Loss: {}.".format(result[2]))
                 self.logger.debug("Send DONE.")
-                self.comm.send((i, j, loss), dest=0, tag=Tags.DONE)
+                self.send(result, dest=0, tag=Tags.DONE)
+                mystatus = Tags.READY
+            elif tag == Tags.SCREEN:
+                self.logger.debug("Received SCREEN.")
+                i, j = data
+                result = self.run_task(i, j, self.candidate(Ml, [(i, j)]), res=self.screen_res)
+                self.logger.debug("Screening loss: {}.".format(result[2]))
+                self.logger.debug("Send DONE.")
+                self.send(result, dest=0, tag=Tags.DONE)
+                mystatus = Tags.READY
+            elif tag == Tags.ADJOINT:
+                self.logger.debug("Received ADJOINT.")
+                sens = self.run_adjoint(Ml)
+                self.logger.debug("Send DONE.")
+                self.send(sens.ravel(), dest=0, tag=Tags.DONE)
                 mystatus = Tags.READY
             elif tag == Tags.WAIT:
                 self.logger.debug("Received WAIT.")
@@ -214,15 +790,34 @@ class BSWOpt(object):
             elif tag == Tags.CONTINUE:
                 self.logger.debug("Received CONTINUE.")
                 mystatus = Tags.READY
+            elif tag == Tags.UPDATE:
+                self.logger.debug("Received UPDATE.")
+                for i, j in data.reshape((-1, 2)):
+                    Ml[i, j] = 1
+                mystatus = Tags.READY
             elif tag == Tags.STOP:
                 self.logger.debug("Received STOP.")
                 mystatus = Tags.STOP
                 break
         # cleanup
-        self.comm.send(None, dest=0, tag=mystatus)
+        self.send((), dest=0, tag=mystatus)
 
-    def create_sim(self, matrix=[]):
-        bsw = BSWFocus(sim_resolution=self.res,
+    def candidate(self, Ml, flips):
+        """Full design matrix with the pixels (i, j) in flips and their mirror images set"""
+        tMl = np.copy(Ml)
+        for i, j in flips:
+            tMl[i, j] = 1
+        return np.vstack((tMl, np.flipud(tMl)))
+
+    def create_sim(self, matrix=[], res=None):
+        res = res or self.res
+        persistent = self.matgrid or self.backend == 'fdfd'
+        if persistent and res in self.bsw:
+            # keep the initialized simulation, only update the design region
+            self.bsw[res].set_design(matrix)
+            return self.bsw[res]
+        sim_class = FDFDFocus if self.backend == 'fdfd' else BSWFocus
+        bsw = sim_class(sim_resolution=res,
                        design_yr=self.design_yr,
                        design_xr=self.design_xr,
                        sx=self.sx,
@@ -231,50 +826,133 @@ class BSWOpt(object):
                        n_hi=self.n_hi,
                        spacing=self.space,
                        box_sx=self.box_sx,
-                       box_sy=self.box_sy)
+                       box_sy=self.box_sy,
+                       **self.sim_options)
         bsw.set_design(matrix)
+        if persistent and len(matrix):
+            self.bsw[res] = bsw
         return bsw
 
-    def get_loss(self, bsw):
-        if self.loss == 'field':
-            # max field loss. simple, effective.
-            field = bsw.get_focus_box_field()
-            out = np.square(np.linalg.norm(field))
-        elif self.loss == 'fwhm':
-            # pure fwhm loss
-            _, _, spline = bsw.get_focus_fwhm(sx=3)
-            if spline is not None:
-                roots = spline.roots()
-                middle = float(len(roots)) / 2.
-                r1, r2 = roots[int(middle - 0.5)], roots[int(middle + 0.5)]
-                fwhm = np.abs(r2 - r1)
-                out = 1. / np.square(fwhm)
-            else:
-                out = 0
-        elif self.loss == 'combined':
-            # require a certain field strength, then optimize for fwhm
-            field = np.linalg.norm(bsw.get_focus_box_field())
-            _, _, spline = bsw.get_focus_fwhm(sx=3)
-            if spline is not None and field > 1:
-                roots = spline.roots()
-                middle = float(len(roots)) / 2.
-                r1, r2 = roots[int(middle - 0.5)], roots[int(middle + 0.5)]
-                ifwhm = 1. / np.abs(r2 - r1)
-                out = np.square(field) + np.square(ifwhm)
-            else:
-                out = np.square(field)
-        return out
+    def run_adjoint(self, Ml):
+        """Returns the sensitivity of the full design, all nan if it failed so that the master re-queues it"""
+        try:
+            bsw = self.create_sim(np.vstack((Ml, np.flipud(Ml))))
+            bsw.run()
+            return bsw.get_sensitivity()
+        except Exception:
+            self.logger.exception("Adjoint sensitivity failed.")
+            return np.full((2 * Ml.shape[0], Ml.shape[1]), np.nan)
+
+    def run_task(self, i, j, tM, res=None):
+        """Evaluates a candidate, returns its loss, wall time, time steps and metric vector for the master.
+        A failed evaluation reports a nan loss, the master re-queues the task.
+        """
+        start = time.time()
+        self.values = np.full(len(metrics.names()), np.nan)
+        try:
+            loss = self.evaluate(i, j, tM, res)
+        except Exception:
+            self.logger.exception("Evaluation of candidate ({}, {}) failed.".format(i, j))
+            loss = np.nan
+        return (i, j, loss, time.time() - start, self.steps) + tuple(self.values)
+
+    def evaluate(self, i, j, tM, res=None):
+        """Returns the loss of candidate (i, j), from the result cache if possible.
+        The number of time steps it took and all registered metrics are kept in self.steps and self.values.
+        The cache stores the metrics, so all objectives share its entries.
+        """
+        bsw = self.create_sim(tM, res)
+        self.steps = 0
+        if self.cache is not None:
+            key = bsw.cache_key('metrics')
+            entry = self.cache.get(key)
+            if entry is not None and list(entry['names']) == metrics.names():
+                self.logger.debug("Cache hit for candidate ({}, {}).".format(i, j))
+                self.values = entry['values']
+                return metrics.loss(self.loss, self.values)
+        if self.backend == 'fdfd':
+            self.set_base(bsw, i, j, tM)
+        bsw.abort = self.cancelled if self.pipeline or self.duplicates else None
+        bsw.run()
+        if bsw.aborted:
+            self.logger.debug("Candidate ({}, {}) cancelled.".format(i, j))
+            return np.nan
+        self.steps = bsw.sim.timestep()
+        if bsw.timed_out:
+            self.logger.warning("Candidate ({}, {}) did not converge within its budget.".format(i, j))
+        self.values = metrics.compute(bsw)
+        if self.cache is not None and not bsw.timed_out:
+            self.cache.put(key, names=np.array(metrics.names()), values=self.values)
+        return metrics.loss(self.loss, self.values)
+
+    def set_base(self, bsw, i, j, tM):
+        """Factorizes the design the candidate (i, j) was derived from, for the fdfd backend"""
+        base = np.copy(tM)
+        base[i, j] = 1 - base[i, j]
+        base[-1 - i, j] = base[i, j]
+        bsw.set_base(base)
 
-    def create_output(self, fname, m, e, t):
-        h5f = h5py.File(fname, 'w')
-        h5f.create_dataset('design', data=m)
-        h5f.create_dataset('focus', data=e)
-        h5f.create_dataset('it_time', data=t)
-        bsw = self.create_sim()
-        simgrp = h5f.create_group('sim')
-        for key, value in bsw.to_dict().items():
-            simgrp.create_dataset(key, data=value)
-        h5f.close()
+    def checkpoint(self, force=False):
+        """Writes the output file with the optimizer state, at most every checkpoint_interval seconds"""
+        if self.state is None or not (force or time.time() - self.last_checkpoint >= self.checkpoint_interval):
+            return
+        self.logger.debug("Writing checkpoint.")
+        self.create_output(self.state['M_list'], self.state['field_list'], self.state['t'])
+
+    def write_state(self):
+        """Journals the state of the current iteration and the results finished so far"""
+        st = self.state
+        grp = {key: st[key] for key in ('Ml', 'max_field', 'margin_counter', 'first_neg', 'iterations')}
+        if st['Ml_bak'] is not None:
+            grp['Ml_bak'] = st['Ml_bak']
+        grp['scores'] = np.array([k + (v,) for k, v in st['scores'].items()])
+        grp['costs'] = np.array([k + tuple(v) for k, v in self.costs.items()])
+        grp['metric_values'] = np.array([k + tuple(v) for k, v in self.metrics.items()])
+        grp['screen_k'] = self.screen_k
+        grp['partial'] = json.dumps([[k, [float(v) for v in r]] for k, r in self.partial.items()])
+        self.journal.checkpoint(grp)
+
+    def read_state(self, data):
+        """Restores the state written by write_state, returns the master loop variables"""
+        grp = data['state']
+        state = {key: grp[key] for key in ('Ml', 'max_field', 'margin_counter', 'first_neg', 'iterations')}
+        state['Ml_bak'] = grp.get('Ml_bak')
+        state['scores'] = {(int(i), int(j)): v for i, j, v in grp['scores'].reshape((-1, 3))}
+        self.costs = {(int(i), int(j)): (c, n) for i, j, c, n in grp['costs'].reshape((-1, 4))}
+        if 'metric_values' in grp:
+            values = grp['metric_values'].reshape((-1, 2 + len(metrics.names())))
+            self.metrics = {(int(v[0]), int(v[1])): tuple(v[2:]) for v in values}
+        self.screen_k = int(grp['screen_k'])
+        self.partial = {tuple(k): (int(r[0]), int(r[1]), r[2]) for k, r in json.loads(grp['partial'])}
+        if 'cost_time' in data:
+            self.cost_list = [np.stack(c) for c in zip(data['cost_time'], data['cost_steps'])]
+        if 'metrics' in data:
+            self.metric_list = data['metrics']
+        if 'screen_rank' in data:
+            self.screen_ranks = data['screen_rank']
+            self.screen_corr = data['screen_corr']
+        return state
+
+    def create_output(self, m, e, t):
+        """Journals the designs and records added since the last call, together with the optimizer state
+        if one is set. The writes happen in the background, the output file is replaced once they are done.
+        """
+        self.journal.sync_designs(m)
+        self.journal.sync('focus', e)
+        self.journal.sync('it_time', t)
+        if self.screen_res:
+            self.journal.sync('screen_rank', self.screen_ranks)
+            self.journal.sync('screen_corr', self.screen_corr)
+        # per iteration and candidate pixel, nan where no candidate was simulated
+        self.journal.sync('cost_time', self.cost_list, item=0)
+        self.journal.sync('cost_steps', self.cost_list, item=1)
+        # per iteration, metric and candidate pixel, in the order of metric_names
+        self.journal.sync('metrics', self.metric_list)
+        if self.state is not None:
+            self.write_state()
+        else:
+            self.journal.checkpoint()
+        self.last_checkpoint = time.time()
 
 
 if __name__ == '__main__':
@@ -295,9 +973,60 @@ if __name__ == '__main__':
     p.add('--sx', type=float, help="Cell size in x")
     p.add('--sy', type=float, help="Cell size in y")
     p.add('--focus_yr', type=float, nargs=2, help="Optimization target y-range")
-    p.add('--infile', type=str, help="Input optimization file")
-    p.add('--loss', type=str, help="Method of calculating loss function")
+    p.add('--infile', type=str, help="Input optimization file, resumed from its last checkpoint")
+    p.add('--checkpoint_interval', type=float, default=300.0,
+          help="Seconds between checkpoints within and between iterations")
+    p.add('--loss', type=str, choices=sorted(metrics.OBJECTIVES),
+          help="Objective computed from the registered metrics (util/metrics.py)")
+    p.add('--adjoint_k', type=int, default=0,
+          help="Only simulate the k candidates with highest adjoint sensitivity per iteration (0 disables)")
+    p.add('--lazy', action='store_true',
+          help="Only re-simulate the best candidates of the last iteration until none can beat them")
+    p.add('--lazy_refresh', type=int, default=10, help="Simulate all candidates every n iterations in lazy mode")
+    p.add('--batch_k', type=int, default=1,
+          help="Accept up to k improving flips per iteration if their combination is verified to be better")
+    p.add('--batch_dist', type=int, default=2, help="Minimum distance in pixels between flips accepted together")
+    p.add('--pipeline', action='store_true',
+          help="Start the next iteration speculatively once the leading candidate is certain")
+    p.add('--task_timeout', type=float, default=0.0,
+          help="Seconds after which a slave is considered dead and its task re-queued (0 disables)")
+    p.add('--timeout_factor', type=float, default=0.0,
+          help="Task deadline as a multiple of the longer of its last and the median run time (0 disables)")
+    p.add('--max_retries', type=int, default=1, help="Re-queue failed or timed out tasks at most this often")
+    p.add('--duplicates', action='store_true',
+          help="Let idle slaves run copies of the longest running tasks and keep the first result")
+    p.add('--screen_res', type=int, default=0,
+          help="Screen all candidates at this resolution first, then only the best at --res (0 disables)")
+    p.add('--screen_k', type=int, default=4, help="Minimum number of screened candidates simulated at --res")
+    p.add('--screen_margin', type=float, default=0.05,
+          help="Also simulate all screened candidates within this relative margin of the best at --res")
+    p.add('--matgrid', action='store_true',
+          help="Keep one simulation per slave and update the design as a material grid")
+    p.add('--backend', type=str, default='meep',
+          help="Simulation backend, 'meep' or 'fdfd' (low-rank updates of one factorization per iteration)")
+    p.add('--cache', type=str, help="Result cache directory shared by all slaves and runs")
+    p.add('--cache_size', type=float, default=0, help="Result cache size limit in MiB (0 disables eviction)")
+    p.add('--monitor', type=str, default='cell',
+          help="Steady state monitor, 'cell' (field norm), 'focus' (complex amplitudes along the focus) "
+               "or 'extrapolate' (extrapolated steady state along the focus)")
+    p.add('--monitor_interval', type=float, default=10.0, help="Time between steady state checks")
+    p.add('--monitor_rtol', type=float, default=1e-5, help="Relative tolerance of the steady state check")
+    p.add('--max_time', type=float, default=0.0, help="Simulation time budget per candidate (0 disables)")
+    p.add('--solver', type=str, default='time',
+          help="Steady state solver, 'time' (time stepping) or 'cw' (frequency domain)")
+    p.add('--cw_tol', type=float, default=1e-8, help="Residual tolerance of the frequency domain solver")
+    p.add('--cw_maxiters', type=int, default=10000, help="Iteration cap of the frequency domain solver")
+    p.add('--auto_cell', action='store_true',
+          help="Crop the cell height to the design and focus regions plus --cell_margin")
+    p.add('--cell_margin', type=float, default=2.0,
+          help="Distance of the cropped cell and its source from the design and focus regions")
+    p.add('--dft', type=str, default='none', choices=['none', 'focus', 'cell'],
+          help="Step real fields and take the steady state amplitudes from a DFT monitor over the "
+               "'focus' region or the whole 'cell' ('none' steps complex fields), "
+               "needs --monitor focus or extrapolate")
     options = p.parse_args()
+    if options.dft != 'none' and options.monitor == 'cell':
+        p.error("--dft needs --monitor focus or extrapolate")
 
     opt = BSWOpt(options)
     try:
@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import h5py
+import os
 import time
 import argparse
 import meep as mp
@@ -9,6 +9,8 @@ import numpy as np
 from datetime import datetime as dt
 from multiprocessing import Pool
 from util.bswfocus import BSWFocus
+from util.journal import Journal
+from util.design import Design
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-d', '--dim', type=int, required=True,
@@ -17,11 +19,14 @@ parser.add_argument('-r', '--res', type=int, default=1,
                     help="Resolution for optimization simulations")
 parser.add_argument('-p', '--processes', type=int, default=None,
                     help="Number of worker processes to spawn")
+parser.add_argument('-m', '--matgrid', action='store_true',
+                    help="Keep one simulation per worker and update the design as a material grid")
 args = parser.parse_args()
 
 dim = args.dim
 resolution = args.res
-nproc = args.processes
+nproc = args.processes or os.cpu_count()
+use_material_grid = args.matgrid
 design_yr = (4, 24)
 focus_yr = (4, -24)
 use_filter = False
@@ -30,24 +35,39 @@ box_sx = 0.5
 n_lo = 1.1
 n_hi = 1.2
 
+# simulation of the worker process, created once by the pool initializer
+bsw = None
 
-def worker(M):
-    bsw = BSWFocus(sim_resolution=resolution,
-                   design_yr=design_yr,
-                   focus_yr=focus_yr,
-                   use_filter=use_filter,
-                   n_lo=n_lo,
-                   n_hi=n_hi,
-                   box_sx=box_sx,
-                   box_sy=box_sy)
-    bsw.set_design(M)
+
+def create_sim():
+    return BSWFocus(sim_resolution=resolution,
+                    design_yr=design_yr,
+                    focus_yr=focus_yr,
+                    use_filter=use_filter,
+                    n_lo=n_lo,
+                    n_hi=n_hi,
+                    box_sx=box_sx,
+                    box_sy=box_sy,
+                    use_material_grid=use_material_grid)
+
+
+def init_worker():
+    global bsw
+    bsw = create_sim()
+
+
+def worker(task):
+    i, j, Ml = task
+    tMl = np.array(Ml)
+    tMl[i, j] = 1
+    bsw.set_design(np.vstack((tMl, np.flipud(tMl))))
     bsw.run()
     field = bsw.get_focus_box_field()
-    return np.square(np.linalg.norm(field))
+    return np.square(np.linalg.norm(field)), i, j
 
 
-def optimize():
-    Ml = np.zeros((int(dim / 2), dim))
+def optimize(pool):
+    Ml = np.zeros((int(dim / 2), dim), dtype=np.uint8)
     margin = 2
     margin_counter = 0
     max_field = 0
@@ -59,17 +79,13 @@ def optimize():
     iterations = 0
     while True:
         t.append(time.time())
-        pool = Pool(processes=nproc)
-
-        results = []
-        for i, j in np.transpose(np.where(Ml == 0)):
-            tMl = np.copy(Ml)
-            tMl[i, j] = 1
-            tM = np.vstack((tMl, np.flipud(tMl)))
-            results.append((pool.apply_async(worker, args=(tM,)), i, j))
-        pool.close()
-        pool.join()
-        res = np.array([(result.get(), int(i), int(j)) for result, i, j in results])
+
+        # the design is pickled for every task, bit-packed it is 1/64 of the float matrix
+        design = Design(Ml)
+        tasks = [(i, j, design) for i, j in np.transpose(np.where(Ml == 0))]
+        chunksize = max(1, len(tasks) // (4 * nproc))
+        # restore the candidate order, ties are resolved as before
+        res = np.array(sorted(pool.imap_unordered(worker, tasks, chunksize=chunksize), key=lambda r: r[1:]))
 
         if not res.any():
             if margin_counter > 0:
@@ -89,7 +105,7 @@ def optimize():
         else:
             max_field = field[0]
             field_list.append(max_field)
-            M_list.append(np.vstack((Ml, np.flipud(Ml))))
+            M_list.append(Design(Ml).mirrored())
             margin_counter = 0
             first_neg = True
 
@@ -100,26 +116,18 @@ def optimize():
             break
 
     print("Optimization finished in {} iterations.".format(iterations))
-    return np.array(M_list), np.array(field_list), np.array(t)
+    return M_list, np.array(field_list), np.array(t)
 
 
 if __name__ == '__main__':
     fname = dt.strftime(dt.now(), '%Y%m%d-%H%M%S')
-    m, e, t = optimize()
-    bsw = BSWFocus(sim_resolution=resolution,
-                   design_yr=design_yr,
-                   focus_yr=focus_yr,
-                   use_filter=use_filter,
-                   n_lo=n_lo,
-                   n_hi=n_hi,
-                   box_sx=box_sx,
-                   box_sy=box_sy)
-    h5f = h5py.File('./run/{}_bsw_{}x{}_res{}.h5'.format(fname, dim, dim, resolution), 'w')
-    h5f.create_dataset('design', data=m)
-    h5f.create_dataset('focus', data=e)
-    h5f.create_dataset('it_time', data=t)
-    simgrp = h5f.create_group('sim')
-    for key, value in bsw.to_dict().items():
-        simgrp.create_dataset(key, data=value)
-    h5f.close()
+    with Pool(processes=nproc, initializer=init_worker) as pool:
+        m, e, t = optimize(pool)
+    bsw = create_sim()
+    journal = Journal('./run/{}_bsw_{}x{}_res{}.h5'.format(fname, dim, dim, resolution))
+    journal.sync_designs(m)
+    journal.sync('focus', e)
+    journal.sync('it_time', t)
+    journal.write_group('sim', bsw.to_dict())
+    journal.close()
 
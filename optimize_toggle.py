@@ -8,18 +8,22 @@ warnings.filterwarnings("ignore", message="numpy.ufunc size changed")
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
 import os
+import json
 import time
 import signal
 import logging
 import logging.config
 import configargparse
 from datetime import datetime
-import h5py
 import numpy as np
 from mpi4py import MPI
 
 # own modules
-from util.bswfocus import BSWFocus
+from util.bswfocus import BSWFocus, FDFDFocus
+from util.cache import ResultCache
+from util.journal import Journal
+from util.design import Design
+from util import metrics
 
 
 # MPI tags (basically an enum)
@@ -46,27 +50,31 @@ class BSWOpt(object):
 
         self.logger.info("Using file {}.".format(self.infile))
 
-        h5f = h5py.File(config.infile, 'r')
-        d = {k: h5f['sim'][k].value for k in h5f['sim'].keys()}
-        self.field_list = list(h5f['focus'])
+        data = Journal.load(config.infile)
+        d = data['sim']
+        self.field_list = data['focus']
         self.max_field = self.field_list[-1]
-        self.M_list = list(h5f['design'])
-        self.Ml = self.M_list[-1][:int(self.M_list[-1].shape[0] / 2)]
-        h5f.close()
+        self.M_list = [Design(m) for m in data['design']]
+        self.Ml = np.asarray(self.M_list[-1])[:int(self.M_list[-1].shape[0] / 2)]
 
         # d.update({
         #     'sim_resolution': config.res,
         # })
 
         self.dim = self.Ml.shape[1]
-        self.res = d['sim_resolution']
-        self.design_yr = d['design_yr']
-        self.focus_yr = d['focus_yr']
-        self.box_sx = d['box_sx']
-        self.box_sy = d['box_sy']
-        self.space = d['spacing']
-        self.n_lo = d['n_lo']
-        self.n_hi = d['n_hi']
+        self.matgrid = config.matgrid
+        self.backend = config.backend
+        # all simulation parameters of the input optimization, so that the cache keys of its results match
+        self.sim_params = {k: v for k, v in d.items() if k != 'design_matrix'}
+        self.sim_params['use_material_grid'] = self.matgrid
+        self.bsw = None
+        self.cache = None if config.cache is None else ResultCache(config.cache, int(config.cache_size * 2**20))
+        # checkpointing, loop state of the current iteration and the results finished so far
+        self.checkpoint_interval = config.checkpoint_interval
+        self.last_checkpoint = time.time()
+        self.state = None
+        self.partial = {}
+        self.journal = None
 
     def start(self):
         if self.size < 2:
@@ -90,35 +98,56 @@ class BSWOpt(object):
         t = []
         M_list = self.M_list
         Ml = self.Ml
+        state = {}
+        if os.path.exists(self.outfile):
+            data = Journal.load(self.outfile)
+            if data['state'] is not None:
+                field_list = data['focus']
+                # the interrupted iteration is restarted
+                t = data['it_time'][:-1]
+                M_list = [Design(m) for m in data['design']]
+                state = self.read_state(data['state'])
+                max_field = state['max_field']
+                Ml = state['Ml']
+                self.logger.info("Resuming iteration {} of {} with {} finished tasks.".format(
+                    state['iterations'] + 1, self.outfile, len(self.partial)))
+            else:
+                # a finished optimization is overwritten
+                os.remove(self.outfile)
+        self.journal = Journal(self.outfile)
+        self.journal.sync('it_time', t)
+        self.journal.write_group('sim', self.create_sim().to_dict())
 
         self.logger.debug("Initial matrix:\n{}".format(Ml))
 
         # optimization control
         margin = 2
-        margin_counter = 0
-        toggle_counter = np.zeros_like(Ml)
-        Ml_bak = None
-        first_neg = True
-        iterations = 0
+        margin_counter = state.get('margin_counter', 0)
+        toggle_counter = state.get('toggle_counter', np.zeros_like(Ml))
+        Ml_bak = state.get('Ml_bak')
+        first_neg = state.get('first_neg', True)
+        iterations = state.get('iterations', 0)
 
         while True:
+            # candidates are sent bit-packed
             tasks = []
+            half = Design(Ml)
             for i1, i2 in np.transpose(np.where(Ml == 0)):
-                tMl = np.copy(Ml)
-                tMl[i1, i2] = 1
-                tM = np.vstack((tMl, np.flipud(tMl)))
-                tasks.append((i1, i2, tM))
+                tasks.append((i1, i2, half.flip((i1, i2)).mirrored()))
             for i1, i2 in np.transpose(np.where(Ml == 1)):
-                tMl = np.copy(Ml)
-                tMl[i1, i2] = 0
-                tM = np.vstack((tMl, np.flipud(tMl)))
-                tasks.append((i1, i2, tM))
-            res_fields = []
-            res_idx = []
+                tasks.append((i1, i2, half.flip((i1, i2)).mirrored()))
+            # results of this iteration from before a restart
+            res_idx = [(i1, i2) for i1, i2, _ in tasks if (i1, i2) in self.partial]
+            res_fields = [self.partial[idx] for idx in res_idx]
+            tasks = [task for task in tasks if task[:2] not in self.partial]
             waitlist = []
             total_tasks = len(tasks)
             distributed_tasks = 0
             t.append(time.time())
+            self.state = {'Ml': np.copy(Ml), 'Ml_bak': Ml_bak, 'max_field': max_field,
+                          'margin_counter': margin_counter, 'first_neg': first_neg, 'iterations': iterations,
+                          'toggle_counter': np.copy(toggle_counter), 'M_list': M_list, 'field_list': field_list, 't': t}
+            self.checkpoint(force=iterations > 0 and iterations % 10 == 0)
 
             while True:
                 self.logger.debug("Receiving...")
@@ -130,6 +159,8 @@ class BSWOpt(object):
                     self.logger.debug("Received DONE from slave {}.".format(source))
                     res_idx.append((data[0], data[1]))
                     res_fields.append(data[2])
+                    self.partial[(int(data[0]), int(data[1]))] = data[2]
+                    self.checkpoint()
                 elif tag == Tags.READY:
                     self.logger.debug("Received READY from slave {}.".format(source))
                     if not tasks or distributed_tasks == total_tasks:
@@ -166,7 +197,7 @@ class BSWOpt(object):
             else:
                 max_field = field
                 field_list.append(max_field)
-                M_list.append(np.vstack((Ml, np.flipud(Ml))))
+                M_list.append(Design(Ml).mirrored())
                 margin_counter = 0
                 first_neg = True
 
@@ -182,14 +213,12 @@ class BSWOpt(object):
                 break
 
             self.logger.debug("Matrix after iteration {}:\n{}".format(iterations, Ml))
+            self.partial = {}
 
             for rank in waitlist:
                 self.logger.debug("Send CONTINUE to slave {}.".format(rank))
                 self.comm.send(None, dest=rank, tag=Tags.CONTINUE)
 
-            if iterations % 10 == 0:
-                self.create_output(self.outfile, np.array(M_list), np.array(field_list), np.array(t))
-
         # let slaves exit gracefully
         for rank in range(1, self.size):
             self.logger.debug("Send STOP to slave {}.".format(rank))
@@ -197,7 +226,9 @@ class BSWOpt(object):
             self.comm.recv(None, source=rank, tag=Tags.STOP)
 
         self.logger.info("Optimization finished in {} iterations.".format(iterations))
-        self.create_output(self.outfile, np.array(M_list), np.array(field_list), np.array(t))
+        self.state = None
+        self.create_output(M_list, field_list, t)
+        self.journal.close()
 
     def slave(self):
         mystatus = Tags.READY
@@ -209,7 +240,7 @@ class BSWOpt(object):
             if tag == Tags.START:
                 self.logger.debug("Received START.")
                 i, j, tM = data
-                field = self.get_sim_field(self.create_sim(tM))
+                field = self.evaluate(i, j, tM)
                 self.logger.debug("Field: {}.".format(field))
                 self.logger.debug("Send DONE.")
                 self.comm.send((i, j, field), dest=0, tag=Tags.DONE)
@@ -228,32 +259,80 @@ class BSWOpt(object):
         self.comm.send(None, dest=0, tag=mystatus)
 
     def create_sim(self, matrix=[]):
-        bsw = BSWFocus(sim_resolution=self.res,
-                       design_yr=self.design_yr,
-                       focus_yr=self.focus_yr,
-                       n_lo=self.n_lo,
-                       n_hi=self.n_hi,
-                       spacing=self.space,
-                       box_sx=self.box_sx,
-                       box_sy=self.box_sy)
+        persistent = self.matgrid or self.backend == 'fdfd'
+        if persistent and self.bsw is not None:
+            # keep the initialized simulation, only update the design region
+            self.bsw.set_design(matrix)
+            return self.bsw
+        sim_class = FDFDFocus if self.backend == 'fdfd' else BSWFocus
+        bsw = sim_class(**self.sim_params)
         bsw.set_design(matrix)
+        if persistent and len(matrix):
+            self.bsw = bsw
         return bsw
 
-    def get_sim_field(self, bsw):
+    def evaluate(self, i, j, tM):
+        """Returns the focus field of candidate (i, j), from the result cache if possible.
+        The cache stores the metrics like optimize_bsw_mpi.py, so the entries of the input optimization are reused.
+        """
+        bsw = self.create_sim(tM)
+        if self.cache is not None:
+            key = bsw.cache_key('metrics')
+            entry = self.cache.get(key)
+            if entry is not None and list(entry['names']) == metrics.names():
+                self.logger.debug("Cache hit for candidate ({}, {}).".format(i, j))
+                return metrics.loss('field', entry['values'])
+        if self.backend == 'fdfd':
+            self.set_base(bsw, i, j, tM)
         bsw.run()
-        field = bsw.get_focus_box_field()
-        return np.square(np.linalg.norm(field))
-
-    def create_output(self, fname, m, e, t):
-        h5f = h5py.File(fname, 'w')
-        h5f.create_dataset('design', data=m)
-        h5f.create_dataset('focus', data=e)
-        h5f.create_dataset('it_time', data=t)
-        bsw = self.create_sim()
-        simgrp = h5f.create_group('sim')
-        for key, value in bsw.to_dict().items():
-            simgrp.create_dataset(key, data=value)
-        h5f.close()
+        values = metrics.compute(bsw)
+        if self.cache is not None and not bsw.timed_out:
+            self.cache.put(key, names=np.array(metrics.names()), values=values)
+        return metrics.loss('field', values)
+
+    def set_base(self, bsw, i, j, tM):
+        """Factorizes the design the candidate (i, j) was derived from, for the fdfd backend"""
+        base = np.copy(tM)
+        base[i, j] = 1 - base[i, j]
+        base[-1 - i, j] = base[i, j]
+        bsw.set_base(base)
+
+    def checkpoint(self, force=False):
+        """Writes the output file with the optimizer state, at most every checkpoint_interval seconds"""
+        if self.state is None or not (force or time.time() - self.last_checkpoint >= self.checkpoint_interval):
+            return
+        self.logger.debug("Writing checkpoint.")
+        self.create_output(self.state['M_list'], self.state['field_list'], self.state['t'])
+
+    def write_state(self):
+        """Journals the state of the current iteration and the results finished so far"""
+        keys = ('Ml', 'max_field', 'margin_counter', 'first_neg', 'iterations', 'toggle_counter')
+        grp = {key: self.state[key] for key in keys}
+        if self.state['Ml_bak'] is not None:
+            grp['Ml_bak'] = self.state['Ml_bak']
+        grp['partial'] = json.dumps([[k, float(v)] for k, v in self.partial.items()])
+        self.journal.checkpoint(grp)
+
+    def read_state(self, grp):
+        """Restores the state written by write_state, returns the master loop variables"""
+        keys = ('Ml', 'max_field', 'margin_counter', 'first_neg', 'iterations', 'toggle_counter')
+        state = {key: grp[key] for key in keys}
+        state['Ml_bak'] = grp.get('Ml_bak')
+        self.partial = {tuple(k): v for k, v in json.loads(grp['partial'])}
+        return state
+
+    def create_output(self, m, e, t):
+        """Journals the designs and records added since the last call, together with the optimizer state
+        if one is set. The writes happen in the background, the output file is replaced once they are done.
+        """
+        self.journal.sync_designs(m)
+        self.journal.sync('focus', e)
+        self.journal.sync('it_time', t)
+        if self.state is not None:
+            self.write_state()
+        else:
+            self.journal.checkpoint()
+        self.last_checkpoint = time.time()
 
 
 if __name__ == '__main__':
@@ -263,6 +342,14 @@ if __name__ == '__main__':
     p.add('--logconf', type=str, help="Logging config file")
     p.add('--res', type=int, help="Resolution for simulations")
     p.add('--infile', type=str, help="Input optimization file", required=True)
+    p.add('--matgrid', action='store_true',
+          help="Keep one simulation per slave and update the design as a material grid")
+    p.add('--backend', type=str, default='meep',
+          help="Simulation backend, 'meep' or 'fdfd' (low-rank updates of one factorization per iteration)")
+    p.add('--checkpoint_interval', type=float, default=300.0,
+          help="Seconds between checkpoints within and between iterations, an existing checkpoint is resumed")
+    p.add('--cache', type=str, help="Result cache directory shared by all slaves and runs")
+    p.add('--cache_size', type=float, default=0, help="Result cache size limit in MiB (0 disables eviction)")
     options = p.parse_args()
 
     opt = BSWOpt(options)
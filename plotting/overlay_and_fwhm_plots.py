@@ -8,6 +8,7 @@ import numpy as np
 from ..util.bswfocus import BSWFocus
 from ..util.plotter import *
 from ..util.geometry import make_isosceles
+from ..util.journal import read_designs
 
 
 def overlay_plots(bsw, fname, savefig=''):
@@ -121,7 +122,7 @@ def main(args):
     for fpath in args.file:
         h5f = h5py.File(fpath, 'r')
         d = {k: h5f['sim'][k].value for k in h5f['sim'].keys()}
-        m = np.array(h5f['design'])
+        m = read_designs(h5f)
         h5f.close()
 
         d.update({
@@ -8,6 +8,8 @@ import meep as mp
 import numpy as np
 from datetime import datetime
 from ..util.bswfocus import BSWFocus
+from ..util.cache import ResultCache
+from ..util.journal import read_designs
 from matplotlib.backends.backend_pdf import PdfPages
 from matplotlib import gridspec, colorbar
 from matplotlib.colors import PowerNorm
@@ -25,7 +27,7 @@ def main(args):
     for fname in args.file:
         h5f = h5py.File(fname, 'r')
         d = {k: h5f['sim'][k].value for k in h5f['sim'].keys()}
-        m = np.array(h5f['design'])
+        m = read_designs(h5f)
         h5f.close()
         res = 10
         d.update({
@@ -33,17 +35,20 @@ def main(args):
         })
         bsw = BSWFocus(**d)
         bsw.set_design(m[-1])
+        if args.cache is not None:
+            bsw.cache = ResultCache(args.cache)
+            bsw.cache_fields = True
         fnames.append(os.path.splitext(os.path.basename(fname))[0])
         bsw.run()
 
-        eps = bsw.sim.get_array(center=mp.Vector3(0, 0),
+        eps = bsw.sim.get_array(center=bsw.cell_center,
                                 size=mp.Vector3(bsw.sx, bsw.sy),
                                 component=mp.Dielectric)
         epsilons.append(eps)
-        ex = bsw.sim.get_array(center=mp.Vector3(0, 0),
+        ex = bsw.sim.get_array(center=bsw.cell_center,
                                size=mp.Vector3(bsw.sx, bsw.sy),
                                component=mp.Ex)
-        ey = bsw.sim.get_array(center=mp.Vector3(0, 0),
+        ey = bsw.sim.get_array(center=bsw.cell_center,
                                size=mp.Vector3(bsw.sx, bsw.sy),
                                component=mp.Ey)
         fields.append(np.real(ex))
@@ -87,5 +92,7 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-f', '--file', type=str, nargs='+', required=True,
                         help="Input file(s)")
+    parser.add_argument('--cache', type=str, default=None,
+                        help="Result cache directory for the simulated fields")
     args = parser.parse_args()
     main(args)
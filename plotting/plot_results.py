@@ -8,12 +8,13 @@ import numpy as np
 from ..util.bswfocus import BSWFocus
 from ..util.plotter import *
 from ..util.geometry import make_isosceles
+from ..util.journal import read_designs
 
 
 def main(args):
     h5f = h5py.File(args.file, 'r')
     d = {k: h5f['sim'][k].value for k in h5f['sim'].keys()}
-    m = np.array(h5f['design'])
+    m = read_designs(h5f)
     e = np.array(h5f['focus'])
     t = np.array(h5f['it_time'])
     h5f.close()
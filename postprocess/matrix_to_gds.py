@@ -18,6 +18,7 @@ from gdshelpers.helpers import id_to_alphanumeric
 from gdshelpers.geometry import convert_to_gdscad, geometric_union
 
 from util.bswfocus import BSWFocus
+from util.journal import read_designs
 
 
 def parse_cmdline():
@@ -38,7 +39,7 @@ def parse_cmdline():
 def get_cell(fname, col, row, layer, dist):
     h5f = h5py.File(fname, 'r')
     d = {k: h5f['sim'][k].value for k in h5f['sim'].keys()}
-    design = np.fliplr(h5f['design'][-1])
+    design = np.fliplr(read_designs(h5f)[-1])
     box_intensity = float(np.array(h5f['focus'][-1]))
     fwhm = float(np.array(h5f['fwhm']))
     fwhm_intensity = float(np.array(h5f['fwhm_intensity']))
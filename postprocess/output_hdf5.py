@@ -5,9 +5,10 @@ import os
 import h5py
 import argparse
 import meep as mp
-import numpy as np
 from datetime import datetime
 from util.bswfocus import BSWFocus
+from util.cache import ResultCache
+from util.journal import read_designs
 
 
 def main(args):
@@ -15,7 +16,7 @@ def main(args):
     for fname in args.file:
         h5f = h5py.File(fname, 'r')
         d = {k: h5f['sim'][k].value for k in h5f['sim'].keys()}
-        m = np.array(h5f['design'])
+        m = read_designs(h5f)
         h5f.close()
         res = 20
         d.update({
@@ -23,26 +24,29 @@ def main(args):
         })
         bsw = BSWFocus(**d)
         bsw.set_design(m[-1])
+        if args.cache is not None:
+            bsw.cache = ResultCache(args.cache)
+            bsw.cache_fields = True
         bsw.run()
 
         h5f = h5py.File('/scratch/local/data/fields/{}_fields.h5'.format(os.path.splitext(os.path.basename(fname))[0], 'w'))
 
-        eps = bsw.sim.get_array(center=mp.Vector3(0, 0),
+        eps = bsw.sim.get_array(center=bsw.cell_center,
                                 size=mp.Vector3(bsw.sx, bsw.sy),
                                 component=mp.Dielectric)
         h5f['Dielectric'] = eps
 
-        ex = bsw.sim.get_array(center=mp.Vector3(0, 0),
+        ex = bsw.sim.get_array(center=bsw.cell_center,
                                size=mp.Vector3(bsw.sx, bsw.sy),
                                component=mp.Ex)
         h5f['Ex'] = ex
 
-        ey = bsw.sim.get_array(center=mp.Vector3(0, 0),
+        ey = bsw.sim.get_array(center=bsw.cell_center,
                                size=mp.Vector3(bsw.sx, bsw.sy),
                                component=mp.Ey)
         h5f['Ey'] = ey
 
-        hz = bsw.sim.get_array(center=mp.Vector3(0, 0),
+        hz = bsw.sim.get_array(center=bsw.cell_center,
                                size=mp.Vector3(bsw.sx, bsw.sy),
                                component=mp.Hz)
         h5f['Hz'] = hz
@@ -53,5 +57,7 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-f', '--file', type=str, nargs='+', required=True,
                         help="Input file(s)")
+    parser.add_argument('--cache', type=str, default=None,
+                        help="Result cache directory for the simulated fields")
     args = parser.parse_args()
     main(args)
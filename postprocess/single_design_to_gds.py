@@ -15,6 +15,8 @@ from shapely.geometry import box
 from gdsCAD.core import Cell, Layout
 from gdshelpers.geometry import convert_to_gdscad
 
+from util.journal import read_designs
+
 
 def parse_cmdline():
     parser = argparse.ArgumentParser()
@@ -32,7 +34,7 @@ def main():
     for fname in args.files:
         h5f = h5py.File(fname, 'r')
         d = {k: h5f['sim'][k].value for k in h5f['sim'].keys()}
-        design = np.fliplr(h5f['design'][-1])
+        design = np.fliplr(read_designs(h5f)[-1])
         h5f.close()
 
         spacing = float(d['spacing'])
@@ -8,10 +8,17 @@ import numpy as np
 from scipy.signal import savgol_filter
 from scipy.interpolate import UnivariateSpline
 from lmfit.models import GaussianModel
-from util.geometry import meep_from_design
+from util.geometry import meep_from_design, pixel_grid, pixel_index, rasterize_design, sample_design
+from util.convergence import CellMonitor, RegionMonitor, ExtrapolationMonitor, DFTSampler, HFIELDS
+from util.convergence import add_dft_fields, real_amplitude
+from util.fdfd import FDFDSolver
+from util.cache import ResultCache
+from util.peaks import half_max_width
 
 
 class BSWFocus(object):
+    cell_components = {'ex': mp.Ex, 'ey': mp.Ey, 'hz': mp.Hz, 'eps': mp.Dielectric}
+
     def __init__(self, **kwargs):
         self.defaults = {
             'n_hi': 1.3,
@@ -20,7 +27,7 @@ class BSWFocus(object):
             'source_width': 20.0,
             'sim_resolution': 5,
             'sx': 20,
-            'sy': 50,
+            'sy': 50.0,
             'cell_pad_x': 0,
             'box_sx': 1,
             'box_sy': 1,
@@ -29,57 +36,201 @@ class BSWFocus(object):
             'focus_xr': (-10, 10),
             'focus_yr': (-5, -25),
             'dpml': 2.0,
+            'auto_cell': False,
+            'cell_margin': 2.0,
             'use_complex': True,
+            'dft_region': None,
+            'dft_periods': 2,
             'use_symmetry': True,
             'use_filter': False,
             'k_point': (0, 1, 0),
             'design_matrix': None,
             'spacing': 0.0,
+            'use_material_grid': False,
+            'monitor': 'cell',
+            'monitor_interval': 10.0,
+            'monitor_rtol': 1e-5,
+            'monitor_atol': 1e-8,
+            'probe_points': (),
+            'max_time': 0.0,
+            'solver': 'time',
+            'cw_tol': 1e-8,
+            'cw_maxiters': 10000,
+            'cw_L': 10,
         }
         self.from_kwargs(**kwargs)
 
         if self.k_point:
             self.k_point = mp.Vector3(*self.k_point)
+        if self.dft_region is not None:
+            if self.dft_region not in ('focus', 'cell'):
+                raise ValueError('Unknown DFT region {}'.format(self.dft_region))
+            if self.monitor == 'cell':
+                # its samples would need a DFT over the whole cell, updated at every time step
+                raise ValueError("Monitor 'cell' does not support a DFT region, use 'focus' or 'extrapolate'")
+            # real fields are stepped, the DFT amplitudes replace the complex fields
+            self.use_complex = False
+        self.cell_center = mp.Vector3()
+        self.full_cell = mp.Vector3(2 * self.cell_pad_x + self.sx + 2 * self.dpml, self.sy + 2 * self.dpml)
+        if self.auto_cell:
+            self.crop_cell()
         self.cell = mp.Vector3(2 * self.cell_pad_x + self.sx + 2 * self.dpml, self.sy + 2 * self.dpml)
-        self.current_field = np.nan
-        self.last_field = np.nan
         self.field_component = mp.Ex
         self.eps_lo = np.square(self.n_lo)
         self.eps_hi = np.square(self.n_hi)
         self.sources = [mp.Source(mp.ContinuousSource(wavelength=self.wavelength, width=self.source_width),
                                   component=mp.Hz,
-                                  center=mp.Vector3(0, self.sy / 2),
+                                  center=mp.Vector3(0, self.cell_center.y + self.sy / 2),
                                   size=mp.Vector3(self.cell[0], 0))]
         self.symmetry = [mp.Mirror(direction=mp.X, phase=-1)] if self.use_symmetry else []
         self.pml_layers = [mp.PML(self.dpml)]
         self.design = []
+        self.material_grid = None
+        self.monitor_obj = self.make_monitor()
+        self.timed_out = False
+        # optional callable polled at every time step, a true result stops the run
+        self.abort = None
+        self.aborted = False
+        self.cache = None
+        self.cache_fields = False
+        self.cacheable = False
         self.sim = None
+        # field over the focus region, extracted once per run, region_yr defaults to focus_yr
+        self.focus_region = None
+        self.region_yr = None
+        # steady state amplitudes of the last run from the DFT monitor, see record_dft
+        self.dft = None
+        # demodulates the monitor samples of real fields during a run
+        self.sampler = None
+
+    def crop_cell(self):
+        """Shrinks sy to the design region and the focus region padded by the focus box,
+        cell_margin away from both, and moves the cell center onto them.
+        The source stays at the top of the cell, cell_margin above the highest of them, which
+        for the plane wave in the uniform cladding only changes its phase at the design.
+        A cell smaller than that is kept as is.
+        """
+        ys = list(self.design_yr) + list(self.get_metric_yr())
+        y0, y1 = min(ys) - self.cell_margin, max(ys) + self.cell_margin
+        # snap outwards onto the grid lines of a cell centered at y = 0, so the design is rasterized alike
+        y0 = np.floor(y0 * self.sim_resolution + 1e-9) / self.sim_resolution
+        y1 = np.ceil(y1 * self.sim_resolution - 1e-9) / self.sim_resolution
+        if y1 - y0 <= self.sy + 1e-9:
+            self.sy = float(y1 - y0)
+            self.cell_center = mp.Vector3(0, float(y0 + y1) / 2.)
+
+    def cell_savings(self):
+        """Returns the fraction of the cell area, PML included, saved by crop_cell"""
+        return 1. - (self.cell.x * self.cell.y) / (self.full_cell.x * self.full_cell.y)
+
+    def make_monitor(self):
+        """Creates the steady state monitor.
+        'cell' compares the field norm over the whole cell, 'focus' compares complex
+        amplitudes along the focus box column and at the probe points, 'extrapolate'
+        stops once the steady state over the focus region can be extrapolated.
+        """
+        regions = [(mp.Vector3(np.mean(self.focus_xr), np.mean(self.focus_yr)),
+                    mp.Vector3(self.box_sx, np.abs(self.focus_yr[1] - self.focus_yr[0])))]
+        regions += [(mp.Vector3(*p), mp.Vector3()) for p in self.probe_points]
+        if self.monitor == 'extrapolate':
+            # the full focus region, so that all focus metrics read the extrapolated steady state
+            yr = self.get_metric_yr()
+            regions[0] = (mp.Vector3(0, np.mean(yr)), mp.Vector3(self.cell[0], np.abs(yr[1] - yr[0])))
+        if self.monitor == 'cell':
+            return CellMonitor(self.field_component, self.cell_center, self.monitor_rtol, self.monitor_atol)
+        elif self.monitor == 'focus':
+            return RegionMonitor(self.field_component, regions, 1. / self.wavelength,
+                                 self.monitor_rtol, self.monitor_atol)
+        elif self.monitor == 'extrapolate':
+            return ExtrapolationMonitor(self.field_component, regions, 1. / self.wavelength,
+                                        self.monitor_rtol, self.monitor_atol)
+        raise ValueError('Unknown monitor {}'.format(self.monitor))
+
+    def get_monitor_interval(self):
+        """Returns the check interval, at least one period for real fields so that their
+        amplitudes can be demodulated over it
+        """
+        if self.use_complex:
+            return self.monitor_interval
+        return max(self.monitor_interval, self.wavelength)
 
     def stop_sim(self, *args):
-        """Stops the simulation if field did not change between last time steps"""
-        if np.allclose(self.current_field, self.last_field):
+        """Stops the simulation if field did not change between last time steps,
+        once max_time is exceeded or if abort returns true. Aborted runs count as timed out.
+        """
+        if self.abort is not None and self.abort():
+            self.aborted = self.timed_out = True
+            return True
+        if self.max_time and self.sim.meep_time() >= self.max_time:
+            self.timed_out = True
             return True
-        return False
+        return self.monitor_obj.converged()
+
+    def get_metric_yr(self):
+        """Returns focus_yr padded by half the focus box, the y-range the focus metrics read"""
+        return min(self.focus_yr) - self.box_sy / 2., max(self.focus_yr) + self.box_sy / 2.
+
+    def get_steady_region(self):
+        """Returns the extrapolated steady state over the focus region as ArraySimulation, if available"""
+        steady_state = getattr(self.monitor_obj, 'steady_state', None)
+        if steady_state is None or self.timed_out:
+            return None
+        center = self.monitor_obj.regions[0][0]
+        return self.array_region({self.field_component: self.monitor_obj.split(steady_state)[0]}, center)
+
+    def array_region(self, fields, center):
+        """Wraps field arrays of equal shape centered at center as ArraySimulation"""
+        n, res = np.shape(next(iter(fields.values()))), self.sim.resolution
+        xs = center.x + np.linspace(-(n[0] - 1) / (2. * res), (n[0] - 1) / (2. * res), n[0])
+        ys = center.y + np.linspace(-(n[1] - 1) / (2. * res), (n[1] - 1) / (2. * res), n[1])
+        return ArraySimulation(fields, xs, ys, res)
 
     def set_design(self, design, xr=None, yr=None):
         """Sets the simulation geometry.
         The design can be either a list of meep geometry objects or a design matrix.
+        With use_material_grid, a design matrix only updates the weights of a material grid
+        so that an existing simulation can be reused.
         """
+        self.cacheable = type(design) != list
         if type(design) == list:
             self.design = design
+            if self.material_grid is not None:
+                self.material_grid = None
+                self.sim = None
         else:
             if xr is None:
                 xr = self.design_xr
             if yr is None:
                 yr = self.design_yr
+            # packed designs are unpacked once here
+            design = np.asarray(design)
             self.design_matrix = design
-            self.design = meep_from_design(design, xr, yr, self.eps_hi, self.spacing)
+            if self.use_material_grid:
+                self.set_material_grid(design, xr, yr)
+            else:
+                self.design = meep_from_design(design, xr, yr, self.eps_hi, self.spacing)
+
+    def set_material_grid(self, design, xr, yr):
+        """Represents the design region by a single material grid block"""
+        weights, size = rasterize_design(design, xr, yr, self.sim_resolution, self.spacing)
+        if self.material_grid is not None and self.material_grid.grid_size == mp.Vector3(*weights.shape):
+            self.material_grid.update_weights(weights)
+            return
+        self.material_grid = mp.MaterialGrid(mp.Vector3(*weights.shape),
+                                             mp.Medium(epsilon=self.eps_lo),
+                                             mp.Medium(epsilon=self.eps_hi),
+                                             weights=weights)
+        self.design = [mp.Block(size=mp.Vector3(*size),
+                                center=mp.Vector3(np.mean(xr), np.mean(yr)),
+                                material=self.material_grid)]
+        self.sim = None
 
 
     def append_design(self, design, xr=None, yr=None):
         """Appends meep geometry objects to the simulation geometry.
         The design can be either a list of meep geometry objects or a design matrix.
         """
+        self.cacheable = False
         if type(design) == list:
             self.design += design
         else:
@@ -87,6 +238,7 @@ class BSWFocus(object):
                 xr = self.design_xr
             if yr is None:
                 yr = self.design_yr
+            design = np.asarray(design)
             self.design_matrix = design
             self.design += meep_from_design(design, xr, yr, self.eps_hi, self.spacing)
 
@@ -97,18 +249,17 @@ class BSWFocus(object):
                                  sources=self.sources,
                                  boundary_layers=self.pml_layers,
                                  default_material=mp.Medium(epsilon=self.eps_lo),
+                                 geometry_center=self.cell_center,
                                  force_complex_fields=self.use_complex,
                                  symmetries=self.symmetry,
                                  k_point=self.k_point,
                                  resolution=self.sim_resolution)
 
     def next_field(self, *args):
-        """Stores current and last electric field matrix for stop condition"""
-        self.last_field = self.current_field
-        field = self.sim.get_array(center=mp.Vector3(0, 0, 0),
-                                   size=self.sim.cell_size,
-                                   component=self.field_component)
-        self.current_field = np.linalg.norm(field)
+        """Stores current and last field sample for stop condition.
+        Real fields are sampled as amplitudes demodulated over the check interval.
+        """
+        self.monitor_obj.update(self.sim if self.sampler is None else self.sampler)
 
     def get_focus_y(self, xr=None, yr=None, use_filter=None):
         """Returns the y-axis location of highest electric field amplitude"""
@@ -118,9 +269,8 @@ class BSWFocus(object):
             yr = self.focus_yr
         if use_filter is None:
             use_filter = self.use_filter
-        field_y = self.sim.get_array(center=mp.Vector3(np.mean(xr), np.mean(yr)),
-                                  size=mp.Vector3(0, np.abs(yr[1] - yr[0])),
-                                  component=self.field_component)
+        field_y = self.get_focus_array(center=mp.Vector3(np.mean(xr), np.mean(yr)),
+                                       size=mp.Vector3(0, np.abs(yr[1] - yr[0])))
         field_y = np.square(np.abs(field_y)).T
         if use_filter:
             savg_field_y = self.get_filter(field_y)
@@ -129,6 +279,44 @@ class BSWFocus(object):
             yloc = np.mean(np.where(field_y == field_y.max())[0][:])
         return np.abs(yr[1] - yr[0]) / 2 - yloc / self.sim.resolution
 
+    def set_focus_region(self, yr):
+        """Sets the y-range extracted by get_focus_region, e.g. the union of what all metrics need"""
+        if self.region_yr is None or tuple(yr) != tuple(self.region_yr):
+            self.region_yr = tuple(yr)
+            self.focus_region = None
+
+    def get_focus_region(self):
+        """Returns the field over the full cell width and region_yr as ArraySimulation.
+        It is extracted from the simulation once per run and shared by all focus metrics.
+        With the 'extrapolate' monitor it is the extrapolated steady state over the monitored region,
+        also in place of DFT amplitudes, which still contain the remaining transient.
+        """
+        if self.focus_region is None:
+            self.focus_region = self.get_steady_region()
+        if self.focus_region is None:
+            yr = self.focus_yr if self.region_yr is None else self.region_yr
+            center = mp.Vector3(0, np.mean(yr))
+            size = mp.Vector3(self.sim.cell_size.x, np.abs(yr[1] - yr[0]))
+            field = self.field_sim(self.field_component).get_array(center=center, size=size,
+                                                                   component=self.field_component)
+            self.focus_region = self.array_region({self.field_component: field}, center)
+        return self.focus_region
+
+    def get_focus_array(self, center, size):
+        """Cuts a region out of the focus region, regions reaching outside of it come from the simulation"""
+        region = self.get_focus_region()
+        tol = 0.5 / region.resolution + 1e-9
+        if all(coords[0] - tol <= c - s / 2. and c + s / 2. <= coords[-1] + tol
+               for coords, c, s in ((region.xs, center.x, size.x), (region.ys, center.y, size.y))):
+            return region.get_array(center=center, size=size, component=self.field_component)
+        return self.field_sim(self.field_component).get_array(center=center, size=size, component=self.field_component)
+
+    def field_sim(self, component):
+        """Returns what the steady state of a component is read from, the DFT amplitudes if recorded"""
+        if self.dft is not None and component in self.dft.fields:
+            return self.dft
+        return self.sim
+
     def get_filter(self, data, order=2):
         """Returns filtered data (useful for large oscillations)"""
         return savgol_filter(data, 2 * round(data.shape[0] / 16) - 1, order)
@@ -146,9 +334,8 @@ class BSWFocus(object):
         if use_filter is None:
             use_filter = self.use_filter
         y = self.get_focus_y(xr, yr, use_filter)
-        box_xy = self.sim.get_array(center=mp.Vector3(np.mean(xr), np.mean(yr) - y),
-                                    size=mp.Vector3(box_sx, box_sy),
-                                    component=self.field_component)
+        box_xy = self.get_focus_array(center=mp.Vector3(np.mean(xr), np.mean(yr) - y),
+                                      size=mp.Vector3(box_sx, box_sy))
         return np.abs(box_xy)
 
     def get_focus_intensity_fit(self, xr=None, yr=None, sx=None, use_filter=None):
@@ -162,9 +349,8 @@ class BSWFocus(object):
         if use_filter is None:
             use_filter = self.use_filter
         y = self.get_focus_y(xr, yr, use_filter)
-        fy = self.sim.get_array(center=mp.Vector3(np.mean(xr), np.mean(yr) - y),
-                                size=mp.Vector3(sx, 0),
-                                component=self.field_component)
+        fy = self.get_focus_array(center=mp.Vector3(np.mean(xr), np.mean(yr) - y),
+                                  size=mp.Vector3(sx, 0))
         fy = np.square(np.abs(fy))
         fx = np.linspace(-fy.shape[0] / (2 * self.sim.resolution),
                          fy.shape[0] / (2 * self.sim.resolution), fy.shape[0])
@@ -182,12 +368,10 @@ class BSWFocus(object):
         if sx is None:
             sx = self.box_sx
         y = self.get_focus_y(xr, yr, use_filter=False)
-        fy= self.sim.get_array(center=mp.Vector3(np.mean(xr), np.mean(yr) - y),
-                               size=mp.Vector3(sx, 0),
-                               component=self.field_component)
-        fy_all = self.sim.get_array(center=mp.Vector3(np.mean(xr), np.mean(yr) - y),
-                                    size=mp.Vector3(self.sim.cell_size.x, 0),
-                                    component=self.field_component)
+        fy = self.get_focus_array(center=mp.Vector3(np.mean(xr), np.mean(yr) - y),
+                                  size=mp.Vector3(sx, 0))
+        fy_all = self.get_focus_array(center=mp.Vector3(np.mean(xr), np.mean(yr) - y),
+                                      size=mp.Vector3(self.sim.cell_size.x, 0))
         fy_all = np.square(np.abs(fy_all))
         fy_all -= np.min(fy_all)
         fx_all = np.linspace(-fy_all.shape[0] / (2 * self.sim.resolution),
@@ -207,14 +391,195 @@ class BSWFocus(object):
             spline = None
         return fx_all, fy_all, fx_foc, fy_foc, spline, np.mean(yr) - y
 
+    def get_focus_width(self, xr=None, yr=None, sx=None):
+        """Returns the FWHM of the intensity across the focus, its peak position and intensity.
+        Uses the closed form estimator of util.peaks instead of a spline, nan if there is no half maximum.
+        """
+        if xr is None:
+            xr = self.focus_xr
+        if yr is None:
+            yr = self.focus_yr
+        if sx is None:
+            sx = self.box_sx
+        y = self.get_focus_y(xr, yr, use_filter=False)
+        fy = self.get_focus_array(center=mp.Vector3(np.mean(xr), np.mean(yr) - y), size=mp.Vector3(sx, 0))
+        fy = np.square(np.abs(fy))
+        fx = (np.arange(fy.shape[0]) - (fy.shape[0] - 1) / 2.) / self.sim.resolution
+        width, _, _, x, peak = half_max_width(fx, fy)
+        return float(width), float(x), float(peak)
+
+    def phasor(self, field):
+        """Removes the exp(-iwt) time dependence from a complex field snapshot, DFT amplitudes have none"""
+        if self.dft is not None:
+            return field
+        return field * np.exp(2j * np.pi * self.sim.meep_time() / self.wavelength)
+
+    def get_design_fields(self, xr=None, yr=None):
+        """Returns the Ex and Ey phasors over the design region"""
+        if xr is None:
+            xr = self.design_xr
+        if yr is None:
+            yr = self.design_yr
+        center = mp.Vector3(np.mean(xr), np.mean(yr))
+        size = mp.Vector3(np.abs(xr[1] - xr[0]), np.abs(yr[1] - yr[0]))
+        if self.dft_region == 'focus':
+            raise ValueError('The design fields need complex fields or a DFT over the whole cell')
+        return [self.phasor(self.field_sim(c).get_array(center=center, size=size, component=c)) for c in (mp.Ex, mp.Ey)]
+
+    def get_sensitivity(self, xr=None, yr=None, box_sx=None, box_sy=None, use_filter=None):
+        """Returns the first-order change of the focus box intensity for setting each design pixel.
+        Needs a finished forward run with complex fields, then replaces it by one adjoint run
+        driven by the conjugate forward field in the focus box. The design fields of both runs are
+        read as they are, so both must run to convergence, not stop at a time budget or once the
+        focus region can be extrapolated.
+        """
+        if xr is None:
+            xr = self.focus_xr
+        if yr is None:
+            yr = self.focus_yr
+        if box_sx is None:
+            box_sx = self.box_sx
+        if box_sy is None:
+            box_sy = self.box_sy
+        if use_filter is None:
+            use_filter = self.use_filter
+        y = self.get_focus_y(xr, yr, use_filter)
+        center = mp.Vector3(np.mean(xr), np.mean(yr) - y)
+        # the live field, extrapolated amplitudes are already demodulated
+        box = self.field_sim(self.field_component).get_array(center=center, size=mp.Vector3(box_sx, box_sy),
+                                                              component=self.field_component)
+        box = self.phasor(box)
+        if box.ndim < 2:
+            box = box.reshape((1, -1) if box_sx == 0 else (-1, 1))
+        amp = np.conj(box)
+
+        def amp_func(p):
+            ix = int(np.clip(np.round((p.x + box_sx / 2.) * self.sim_resolution), 0, amp.shape[0] - 1))
+            iy = int(np.clip(np.round((p.y + box_sy / 2.) * self.sim_resolution), 0, amp.shape[1] - 1))
+            return amp[ix, iy]
+
+        fwd = self.get_design_fields()
+        sources = self.sources
+        self.sources = [mp.Source(mp.ContinuousSource(wavelength=self.wavelength, width=self.source_width),
+                                  component=self.field_component,
+                                  center=center,
+                                  size=mp.Vector3(box_sx, box_sy),
+                                  amp_func=amp_func)]
+        try:
+            self.run()
+            adj = self.get_design_fields()
+        finally:
+            self.sources = sources
+
+        # dI = 2 w de Im(E_fwd . E_adj) integrated over the pixel area
+        overlap = fwd[0] * adj[0] + fwd[1] * adj[1]
+        x_range, y_range, width, height = pixel_grid(self.design_matrix.shape, self.design_xr,
+                                                     self.design_yr, spacing=self.spacing)
+        px = np.linspace(np.min(self.design_xr), np.max(self.design_xr), overlap.shape[0])
+        py = np.linspace(np.min(self.design_yr), np.max(self.design_yr), overlap.shape[1])
+        mx = np.abs(px[None, :] - x_range[:, None]) <= width / 2.
+        my = np.abs(py[None, :] - y_range[:, None]) <= height / 2.
+        sens = np.imag(mx.dot(overlap).dot(my.T))
+        return 2 * np.pi / self.wavelength * 2 * (self.eps_hi - self.eps_lo) * sens / np.square(self.sim_resolution)
+
+    def cache_key(self, tag=''):
+        """Returns the result cache key of the current design and parameters"""
+        return ResultCache.key(self.design_matrix, self.to_dict(), '{}:{}'.format(self.__class__.__name__, tag))
+
+    def get_cell_fields(self):
+        """Returns the fields over the whole cell and their grid for the result cache"""
+        fields = {name: self.field_sim(c).get_array(center=self.cell_center, size=self.sim.cell_size, component=c)
+                  for name, c in self.cell_components.items()}
+        n, res, center = fields['eps'].shape, self.sim.resolution, self.cell_center
+        fields['xs'] = center.x + np.linspace(-(n[0] - 1) / (2. * res), (n[0] - 1) / (2. * res), n[0])
+        fields['ys'] = center.y + np.linspace(-(n[1] - 1) / (2. * res), (n[1] - 1) / (2. * res), n[1])
+        return fields
+
     def run(self):
-        """Runs the simulation"""
-        self.init_sim()
+        """Runs the simulation.
+        With a result cache, stored fields of the same design and parameters replace the run
+        and new fields are stored if cache_fields is set. A DFT over the focus region only
+        does not provide cell fields, they are not stored then.
+        """
+        use_cache = self.cache is not None and self.cacheable
+        self.aborted = False
+        self.focus_region = None
+        self.dft = None
+        if use_cache:
+            key = self.cache_key('fields')
+            entry = self.cache.get(key)
+            if entry is not None:
+                fields = {c: entry[name] for name, c in self.cell_components.items()}
+                self.sim = ArraySimulation(fields, entry['xs'], entry['ys'], self.sim_resolution)
+                self.timed_out = False
+                self.monitor_obj.reset()
+                return
+        self.simulate()
+        if use_cache and self.cache_fields and not self.timed_out and self.dft_region != 'focus':
+            self.cache.put(key, **self.get_cell_fields())
+
+    def simulate(self):
+        """Runs the meep simulation.
+        A material grid simulation is only reset, keeping the simulation object.
+        The 'cw' solver computes the steady state directly in the frequency domain
+        and needs complex fields. With dft_region, the steady state amplitudes are
+        recorded after the time stepping.
+        """
+        if self.sim is None or self.material_grid is None or isinstance(self.sim, ArraySimulation):
+            self.init_sim()
+        else:
+            self.sim.reset_meep()
+            self.sim.change_sources(self.sources)
         self.stop = False
-        self.last_field = np.nan
-        self.current_field = np.nan
-        self.sim.run(mp.at_every(10, self.next_field),
-                     until=self.stop_sim)
+        self.timed_out = False
+        self.monitor_obj.reset()
+        if self.solver == 'cw':
+            if self.dft_region is not None:
+                raise ValueError('The cw solver needs complex fields, not a DFT region')
+            self.sim.init_sim()
+            self.timed_out = not self.sim.solve_cw(self.cw_tol, self.cw_maxiters, self.cw_L)
+            return
+        self.sampler = None if self.use_complex else DFTSampler(self.sim, 1. / self.wavelength)
+        try:
+            self.sim.run(mp.at_every(self.get_monitor_interval(), self.next_field),
+                         until=self.stop_sim)
+        finally:
+            if self.sampler is not None:
+                self.sampler.close()
+                self.sampler = None
+        if self.dft_region is not None and not self.aborted:
+            self.record_dft()
+
+    def get_dft_volume(self):
+        """Returns center and size of the DFT monitor.
+        'focus' covers the full cell width over the focus region, or over focus_yr padded by
+        the focus box before a region was set, 'cell' the whole cell.
+        """
+        if self.dft_region == 'cell':
+            return self.cell_center, self.sim.cell_size
+        yr = self.get_metric_yr() if self.region_yr is None else self.region_yr
+        return mp.Vector3(0, np.mean(yr)), mp.Vector3(self.sim.cell_size.x, np.abs(yr[1] - yr[0]))
+
+    def record_dft(self):
+        """Continues the steady state run for dft_periods periods with a DFT monitor at the
+        source frequency and stores the complex amplitudes as ArraySimulation in dft.
+        They are the phasors of the complex field mode, see real_amplitude.
+        Meep samples E at the step times and H half a step earlier.
+        """
+        center, size = self.get_dft_volume()
+        components = [mp.Ex, mp.Ey, mp.Hz] if self.dft_region == 'cell' else [self.field_component]
+        dft = add_dft_fields(self.sim, components, 1. / self.wavelength, center, size)
+        times = []
+        self.sim.run(lambda sim: times.append(sim.meep_time()), until=self.dft_periods * self.wavelength)
+        # a reset material grid simulation would record it again from the start
+        self.sim.dft_objects.remove(dft)
+        times = np.array(times)
+        dt = self.sim.Courant / self.sim.resolution
+        fields = {}
+        for c in components:
+            t = times - (0.5 * dt if c in HFIELDS else 0.)
+            fields[c] = real_amplitude(self.sim.get_dft_array(dft, c, 0), t, 1. / self.wavelength, dt)
+        self.dft = self.array_region(fields, center)
 
     def from_kwargs(self, **kwargs):
         """Restore class settings from dict"""
@@ -231,7 +596,9 @@ class BSWFocus(object):
         for k in sk & sd:
             #FIXME this does not load variables that may change types
             v = kwargs.get(k)
-            if v is None:
+            if isinstance(v, bytes):
+                v = v.decode()
+            if v is None or isinstance(v, str):
                 setattr(self, k, v)
             elif np.isnan(v).any():
                 setattr(self, k, None)
@@ -244,3 +611,140 @@ class BSWFocus(object):
         """
         return {k: (np.nan if vars(self)[k] is None else vars(self)[k]) for k in self.defaults.keys()}
 
+
+class ArraySimulation(object):
+    """Stand-in for mp.Simulation serving get_array from stored field arrays.
+    Fields are given on the grid points xs, ys covering the whole cell.
+    """
+    def __init__(self, fields, xs, ys, resolution):
+        self.fields = fields
+        self.xs = xs
+        self.ys = ys
+        self.resolution = resolution
+        self.cell_size = mp.Vector3(xs[-1] - xs[0] + 1. / resolution, ys[-1] - ys[0] + 1. / resolution)
+
+    def meep_time(self):
+        return 0.
+
+    def timestep(self):
+        return 0
+
+    def get_field(self, component):
+        return self.fields[component]
+
+    def index(self, center, size):
+        """Returns the x and y grid indices of a region, a single index for zero-size dimensions"""
+        index = []
+        for coords, c, s in ((self.xs, center.x, size.x), (self.ys, center.y, size.y)):
+            if s == 0:
+                index.append(int(np.argmin(np.abs(coords - c))))
+            else:
+                index.append(np.where(np.abs(coords - c) <= s / 2. + 1e-9)[0])
+        return index
+
+    def get_array(self, center=mp.Vector3(), size=mp.Vector3(), component=mp.Ex):
+        """Cuts a region out of a stored field, dropping zero-size dimensions like meep"""
+        field = self.get_field(component)
+        index = self.index(center, size)
+        if np.ndim(index[0]) and np.ndim(index[1]):
+            return field[np.ix_(index[0], index[1])]
+        return field[index[0], index[1]]
+
+
+class FDFDSimulation(ArraySimulation):
+    """Stand-in for mp.Simulation holding a steady state FDFD solution"""
+    components = {mp.Ex: 'ex', mp.Ey: 'ey', mp.Hz: 'hz', mp.Dielectric: 'eps'}
+
+    def __init__(self, solver, eps, h):
+        super(FDFDSimulation, self).__init__({}, solver.xs, solver.ys, solver.resolution)
+        self.solver = solver
+        self.eps = eps
+        self.h = h
+
+    def get_field(self, component):
+        if component not in self.fields:
+            self.fields[component] = self.solver.get_field(self.h, self.eps, self.components[component])
+        return self.fields[component]
+
+
+class FDFDFocus(BSWFocus):
+    """BSWFocus with a frequency domain finite difference backend.
+    The system is factorized for a base design (set_base) and designs that differ from
+    it in a few pixels are solved as low-rank updates of that factorization.
+    Only design matrices are supported; with use_symmetry the design is assumed to be
+    mirror symmetric and only the x >= 0 half is solved.
+    """
+    def __init__(self, **kwargs):
+        super(FDFDFocus, self).__init__(**kwargs)
+        self.fdfd = None
+        self.rhs = None
+
+    def init_sim(self):
+        if self.fdfd is not None:
+            return
+        self.fdfd = FDFDSolver((self.cell[0], self.cell[1]), self.sim_resolution, self.wavelength,
+                               self.dpml, symmetric=self.use_symmetry, center_y=self.cell_center.y)
+        self.rhs = sum(self.fdfd.line_source((src.center.x, src.center.y), (src.size.x, src.size.y))
+                       for src in self.sources)
+
+    def get_eps(self, design):
+        """Returns the permittivity on the solver grid"""
+        if design is None:
+            return np.full((len(self.fdfd.xs), len(self.fdfd.ys)), self.eps_lo)
+        weights = sample_design(design, self.design_xr, self.design_yr, self.fdfd.xs, self.fdfd.ys, self.spacing)
+        return self.eps_lo + (self.eps_hi - self.eps_lo) * weights
+
+    def set_design(self, design, xr=None, yr=None):
+        if type(design) == list:
+            if design:
+                raise TypeError('{}() only supports design matrices'.format(self.__class__.__name__))
+            self.design_matrix = None
+            self.cacheable = True
+            return
+        if xr is not None:
+            self.design_xr = xr
+        if yr is not None:
+            self.design_yr = yr
+        self.design_matrix = np.asarray(design)
+        self.cacheable = True
+
+    def set_base(self, design):
+        """Factorizes the system for the design that following candidates are close to"""
+        self.init_sim()
+        self.fdfd.set_base(self.get_eps(design))
+
+    def get_sensitivity(self, xr=None, yr=None, box_sx=None, box_sy=None, use_filter=None):
+        """Returns the first-order change of the focus box intensity for setting each design pixel.
+        Needs a finished run, the gradient takes one solve of the transposed system with the
+        factorization of the design, which is kept as base for the candidates derived from it.
+        """
+        if xr is None:
+            xr = self.focus_xr
+        if yr is None:
+            yr = self.focus_yr
+        if box_sx is None:
+            box_sx = self.box_sx
+        if box_sy is None:
+            box_sy = self.box_sy
+        if use_filter is None:
+            use_filter = self.use_filter
+        if not isinstance(self.sim, FDFDSimulation):
+            # fields from the result cache carry no solution to differentiate
+            self.simulate()
+        y = self.get_focus_y(xr, yr, use_filter)
+        ix, iy = self.sim.index(mp.Vector3(np.mean(xr), np.mean(yr) - y), mp.Vector3(box_sx, box_sy))
+        grad = self.fdfd.intensity_gradient(self.sim.eps, self.sim.h, np.atleast_1d(ix), np.atleast_1d(iy))
+        # sum over the grid cells of each pixel, as sampled by get_eps
+        shape = self.design_matrix.shape
+        px, py, inside_x, inside_y = pixel_index(shape, self.design_xr, self.design_yr,
+                                                 self.fdfd.xs, self.fdfd.ys, self.spacing)
+        mx = (px[None, :] == np.arange(shape[0])[:, None]) & inside_x[None, :]
+        my = (py[None, :] == np.arange(shape[1])[:, None]) & inside_y[None, :]
+        return (self.eps_hi - self.eps_lo) * mx.dot(grad).dot(my.T)
+
+    def simulate(self):
+        """Solves for the steady state field"""
+        self.init_sim()
+        eps = self.get_eps(self.design_matrix)
+        self.timed_out = False
+        self.sim = FDFDSimulation(self.fdfd, eps, self.fdfd.solve(eps, self.rhs))
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import hashlib
+import tempfile
+import numpy as np
+from util.design import Design
+
+
+class ResultCache(object):
+    """Content-addressed on-disk store of simulation results.
+    Entries are keyed on the design matrix (a design and its mirror image share a key)
+    and all simulation parameters. Files are written to a temporary name and renamed,
+    so many processes can share one directory. With max_bytes, the least recently
+    used entries are removed once the directory grows beyond that size.
+    """
+    def __init__(self, path, max_bytes=0, check_every=100):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.check_every = check_every
+        self.puts = 0
+        if not os.path.isdir(path):
+            os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def key(design, params, tag=''):
+        """Returns the hash of a design matrix, simulation parameters and a result tag"""
+        h = hashlib.sha1()
+        if design is not None:
+            design = Design(design)
+            h.update(str(design.shape).encode())
+            h.update(min(design.tobytes(), design.flipud().tobytes()))
+        params = {k: np.asarray(v).tolist() for k, v in params.items() if k != 'design_matrix'}
+        h.update(json.dumps(params, sort_keys=True, default=str).encode())
+        h.update(str(tag).encode())
+        return h.hexdigest()
+
+    def filename(self, key):
+        return os.path.join(self.path, key[:2], key + '.npz')
+
+    def get(self, key):
+        """Returns the stored arrays as dict or None"""
+        fname = self.filename(key)
+        try:
+            with np.load(fname) as npz:
+                entry = {k: npz[k] for k in npz.files}
+            os.utime(fname, None)
+        except (IOError, OSError, ValueError):
+            return None
+        return entry
+
+    def put(self, key, **values):
+        fname = self.filename(key)
+        dirname = os.path.dirname(fname)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **values)
+            os.replace(tmp, fname)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        self.puts += 1
+        if self.max_bytes and self.puts % self.check_every == 0:
+            self.evict()
+
+    def evict(self):
+        """Removes least recently used entries until the cache fits into max_bytes"""
+        entries = []
+        for root, _, files in os.walk(self.path):
+            for name in files:
+                if not name.endswith('.npz'):
+                    continue
+                try:
+                    st = os.stat(os.path.join(root, name))
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, os.path.join(root, name)))
+        total = sum(size for _, size, _ in entries)
+        for _, size, fname in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(fname)
+            except OSError:
+                pass
+            total -= size
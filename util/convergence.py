@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import meep as mp
+import numpy as np
+
+# magnetic components, sampled half a time step before the electric ones
+HFIELDS = (mp.Hx, mp.Hy, mp.Hz)
+
+
+class FieldMonitor(object):
+    """Detects steady state by comparing field samples taken at a fixed interval.
+    Complex samples are demodulated at the given frequency so that amplitudes
+    and phases of a CW field can be compared directly.
+    """
+    def __init__(self, component, frequency=None, rtol=1e-5, atol=1e-8):
+        self.component = component
+        self.frequency = frequency
+        self.rtol = rtol
+        self.atol = atol
+        self.reset()
+
+    def reset(self):
+        self.current = np.nan
+        self.last = np.nan
+
+    def sample(self, sim):
+        raise NotImplementedError
+
+    def update(self, sim):
+        self.last = self.current
+        self.current = self.sample(sim)
+        if self.frequency is not None and np.iscomplexobj(self.current):
+            self.current = self.current * np.exp(2j * np.pi * self.frequency * sim.meep_time())
+
+    def converged(self):
+        if np.shape(self.current) != np.shape(self.last):
+            return False
+        return np.allclose(self.current, self.last, rtol=self.rtol, atol=self.atol)
+
+
+class CellMonitor(FieldMonitor):
+    """Compares the norm of the field over the whole cell"""
+    def __init__(self, component, center, rtol=1e-5, atol=1e-8):
+        super(CellMonitor, self).__init__(component, None, rtol, atol)
+        self.center = center
+
+    def sample(self, sim):
+        field = sim.get_array(center=self.center, size=sim.cell_size, component=self.component)
+        return np.linalg.norm(field)
+
+
+class RegionMonitor(FieldMonitor):
+    """Compares complex amplitudes in a few small regions, given as (center, size) pairs"""
+    def __init__(self, component, regions, frequency=None, rtol=1e-5, atol=1e-8):
+        super(RegionMonitor, self).__init__(component, frequency, rtol, atol)
+        self.regions = regions
+
+    def sample(self, sim):
+        arrays = [sim.get_array(center=center, size=size, component=self.component)
+                  for center, size in self.regions]
+        self.shapes = [np.shape(a) for a in arrays]
+        return np.concatenate([np.ravel(a) for a in arrays])
+
+    def split(self, values):
+        """Splits a flat sample into the arrays of the individual regions"""
+        out, start = [], 0
+        for shape in self.shapes:
+            n = int(np.prod(shape))
+            out.append(np.reshape(values[start:start + n], shape))
+            start += n
+        return out
+
+
+class ExtrapolationMonitor(RegionMonitor):
+    """Fits the last samples to an exponentially settling phasor a + c * r**n.
+    Converged once two consecutive estimates of the steady state a agree,
+    which usually happens long before the samples themselves stop changing.
+    """
+    def __init__(self, component, regions, frequency, rtol=1e-3, atol=1e-8, n_samples=4):
+        super(ExtrapolationMonitor, self).__init__(component, regions, frequency, rtol, atol)
+        self.n_samples = n_samples
+
+    def reset(self):
+        super(ExtrapolationMonitor, self).reset()
+        self.history = []
+        self.steady_state = None
+        self.last_steady_state = None
+        self.transient = np.inf
+
+    def update(self, sim):
+        super(ExtrapolationMonitor, self).update(sim)
+        if not np.all(np.isfinite(self.current)):
+            return
+        self.history = (self.history + [self.current])[-self.n_samples:]
+        self.last_steady_state = self.steady_state
+        self.steady_state, self.transient = self.extrapolate(self.history)
+
+    @staticmethod
+    def extrapolate(history):
+        """Returns steady state estimate and norm of the remaining transient"""
+        if len(history) < 3:
+            return None, np.inf
+        diff = np.diff(np.asarray(history), axis=0)
+        den = np.sum(np.abs(diff[:-1]) ** 2)
+        if den == 0:
+            return history[-1], 0.
+        rate = np.vdot(diff[:-1], diff[1:]) / den
+        if np.abs(rate) >= 1:
+            return None, np.inf
+        correction = diff[-1] * rate / (1 - rate)
+        return history[-1] + correction, np.linalg.norm(correction)
+
+    def converged(self):
+        if self.steady_state is None or self.last_steady_state is None:
+            return False
+        scale = self.rtol * np.linalg.norm(self.steady_state) + self.atol
+        return np.linalg.norm(self.steady_state - self.last_steady_state) <= scale
+
+
+def add_dft_fields(sim, components, frequency, center, size):
+    """Adds a DFT monitor at a single frequency that samples every time step"""
+    try:
+        return sim.add_dft_fields(components, frequency, 0, 1, center=center, size=size, decimation_factor=1)
+    except TypeError:
+        # meep before 1.22 has no decimation and samples every step
+        return sim.add_dft_fields(components, frequency, 0, 1, center=center, size=size)
+
+
+def real_amplitude(dft, times, frequency, dt):
+    """Returns the complex amplitude a of a real field Re(a exp(-iwt)) from its DFT over the given
+    sample times. Meep's DFT, with weights dt / sqrt(2 pi), is (a s0 + a* s2) / 2 with the sums s0
+    of the weights and s2 of the weights times exp(2iwt), which is exact for any window length.
+    """
+    weight = dt / np.sqrt(2 * np.pi)
+    s0 = len(times) * weight
+    s2 = weight * np.sum(np.exp(4j * np.pi * frequency * np.asarray(times)))
+    det = s0 ** 2 - np.abs(s2) ** 2
+    if det <= 0:
+        return np.full(np.shape(dft), np.nan)
+    return 2 * (dft * s0 - np.conj(dft) * s2) / det
+
+
+class DFTSampler(object):
+    """Stand-in for the simulation passed to a monitor when real fields are stepped.
+    get_array returns the complex amplitude at frequency over the time since its last call for
+    the same region, from a DFT monitor over it, and nan on the first call. Real snapshots taken
+    at a fixed interval drift in phase, since the interval is rounded to time steps, these do not.
+    """
+    def __init__(self, sim, frequency):
+        self.sim = sim
+        self.frequency = frequency
+        self.cell_size = sim.cell_size
+        self.resolution = sim.resolution
+        self.dt = sim.Courant / sim.resolution
+        # DFT object, accumulated DFT and time of the last call per region
+        self.regions = {}
+
+    def meep_time(self):
+        # amplitudes carry no exp(-iwt) time dependence
+        return 0.
+
+    def get_array(self, center, size, component):
+        key = (tuple(center), tuple(size), component)
+        t = self.sim.meep_time()
+        if key not in self.regions:
+            dft = add_dft_fields(self.sim, [component], self.frequency, center, size)
+            total = self.sim.get_dft_array(dft, component, 0)
+            self.regions[key] = (dft, total, t)
+            return np.full(np.shape(total), np.nan)
+        dft, last, start = self.regions[key]
+        total = self.sim.get_dft_array(dft, component, 0)
+        self.regions[key] = (dft, total, t)
+        # E is sampled at the steps since the last call, H half a step earlier
+        times = start + self.dt * np.arange(1, int(np.round((t - start) / self.dt)) + 1)
+        if component in HFIELDS:
+            times -= 0.5 * self.dt
+        return real_amplitude(total - last, times, self.frequency, self.dt)
+
+    def close(self):
+        """Removes the DFT monitors, a reset simulation would record them again from the start"""
+        for dft, _, _ in self.regions.values():
+            self.sim.dft_objects.remove(dft)
+        self.regions = {}
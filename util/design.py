@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+
+class Design(object):
+    """Binary design matrix stored as packed bits, 1/64 of the size of the float64 matrix.
+    Converts to a uint8 matrix wherever numpy expects an array. Designs are immutable,
+    flip and the mirror operations return new designs, so they can be hashed and shared.
+    """
+    __slots__ = ('shape', 'bits')
+
+    def __init__(self, matrix):
+        if isinstance(matrix, Design):
+            self.shape, self.bits = matrix.shape, matrix.bits
+            return
+        matrix = np.asarray(matrix)
+        self.shape = tuple(int(n) for n in matrix.shape)
+        self.bits = np.packbits(matrix.astype(bool), axis=None)
+
+    @classmethod
+    def from_bits(cls, shape, bits):
+        design = cls.__new__(cls)
+        design.shape = tuple(int(n) for n in shape)
+        if isinstance(bits, bytes):
+            bits = np.frombuffer(bits, dtype=np.uint8)
+        design.bits = np.asarray(bits, dtype=np.uint8)
+        return design
+
+    def __reduce__(self):
+        # pickled as plain bytes for compact task messages
+        return Design.from_bits, (self.shape, self.bits.tobytes())
+
+    def __array__(self, dtype=None, copy=None):
+        matrix = np.unpackbits(self.bits, count=self.size).reshape(self.shape)
+        return matrix if dtype is None else matrix.astype(dtype)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, idx):
+        if isinstance(idx, tuple) and len(idx) == 2 and all(isinstance(k, (int, np.integer)) for k in idx):
+            k = self.index(*idx)
+            return int(self.bits[k >> 3] >> (7 - (k & 7)) & 1)
+        return np.asarray(self)[idx]
+
+    def index(self, i, j):
+        """Returns the bit index of pixel (i, j), negative indices count from the end like in numpy"""
+        index = []
+        for k, n in zip((int(i), int(j)), self.shape):
+            if not -n <= k < n:
+                raise IndexError("index {} is out of bounds for axis of size {}".format(k, n))
+            index.append(k % n)
+        return index[0] * self.shape[1] + index[1]
+
+    def flip(self, *pixels):
+        """Returns the design with the given (i, j) pixels inverted"""
+        bits = np.copy(self.bits)
+        for i, j in pixels:
+            k = self.index(i, j)
+            bits[k >> 3] ^= 0x80 >> (k & 7)
+        return Design.from_bits(self.shape, bits)
+
+    def flipud(self):
+        """Returns the design mirrored along the first axis"""
+        return Design(np.flipud(np.asarray(self)))
+
+    def mirrored(self):
+        """Returns the full symmetric design of which this is the first half"""
+        matrix = np.asarray(self)
+        return Design(np.vstack((matrix, np.flipud(matrix))))
+
+    def count(self):
+        """Number of set pixels"""
+        return int(np.unpackbits(self.bits).sum())
+
+    def tobytes(self):
+        return self.bits.tobytes()
+
+    def __eq__(self, other):
+        return isinstance(other, Design) and self.shape == other.shape and np.array_equal(self.bits, other.bits)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.shape, self.bits.tobytes()))
+
+    def __repr__(self):
+        return 'Design(shape={}, count={})'.format(self.shape, self.count())
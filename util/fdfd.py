@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.linalg import splu
+
+
+class FDFDSolver(object):
+    """2D finite-difference frequency-domain solver for Hz polarized CW fields.
+    Solves div(1/eps grad Hz) + w^2 Hz = -i w K on a uniform grid of cell centers
+    with stretched-coordinate PML and metallic walls (zero normal derivative of Hz)
+    around the cell, as in meep. With symmetric=True
+    only the x >= 0 half is solved, assuming Hz to be even in x.
+    The operator is factorized once for a base design; permittivity changes of up to
+    max_rank edges are solved as low-rank (Sherman-Morrison-Woodbury) updates of that
+    factorization, which needs one back substitution per changed edge.
+    The cell is centered at x = 0 and y = center_y.
+    """
+    def __init__(self, cell, resolution, wavelength, dpml, symmetric=True, max_rank=None, pml_r=1e-8, center_y=0.):
+        self.resolution = resolution
+        self.dx = 1. / resolution
+        self.symmetric = symmetric
+        self.nx_full = int(np.round(cell[0] * resolution / 2.)) * 2
+        self.nx = int(self.nx_full / 2) if symmetric else self.nx_full
+        self.ny = int(np.round(cell[1] * resolution))
+        self.cell = (self.nx_full * self.dx, self.ny * self.dx)
+        self.omega = 2 * np.pi / wavelength
+        self.fixed_rank = max_rank is not None
+        self.max_rank = max_rank
+        self.xs = (np.arange(self.nx_full) + 0.5) * self.dx - self.cell[0] / 2
+        self.ys = (np.arange(self.ny) + 0.5) * self.dx - self.cell[1] / 2 + center_y
+        self.x0 = 0 if symmetric else -self.cell[0] / 2
+
+        sxc, sxe = self.stretch(self.nx, dpml, pml_r, left=not symmetric)
+        syc, sye = self.stretch(self.ny, dpml, pml_r)
+        ix, iy = sp.identity(self.nx), sp.identity(self.ny)
+        self.dxf = sp.kron(self.forward_difference(self.nx), iy, format='csr')
+        self.dyf = sp.kron(ix, self.forward_difference(self.ny), format='csr')
+        self.sxe = np.kron(sxe, np.ones(self.ny))
+        self.sye = np.kron(np.ones(self.nx), sye)
+        # backward differences include the 1/s factor at the cell centers, their zero
+        # flux through the lower boundary is the mirror condition at x = 0
+        self.dxb = sp.diags(1. / np.kron(sxc, np.ones(self.ny))).dot(-self.dxf.T).tocsr()
+        self.dyb = sp.diags(1. / np.kron(np.ones(self.nx), syc)).dot(-self.dyf.T).tocsr()
+        self.lu = None
+        self.base_eps = None
+        self.base_x = None
+        self.base_y = None
+
+    def stretch(self, n, dpml, pml_r, left=True):
+        """Returns PML stretch factors at cell centers and at the following edges"""
+        npml = dpml * self.resolution
+        sigma_max = -3 * np.log(pml_r) / (2 * dpml)
+        out = []
+        for pos in (np.arange(n) + 0.5, np.arange(n) + 1.):
+            depth = np.maximum(pos - (n - npml), 0)
+            if left:
+                depth = np.maximum(depth, npml - pos)
+            out.append(1 + 1j * sigma_max * np.square(depth / npml) / self.omega)
+        return out
+
+    def forward_difference(self, n):
+        """Differences onto the upper edges, zero on the outermost edge (Neumann wall)"""
+        main = -np.ones(n)
+        main[-1] = 0
+        return sp.diags([main, np.ones(n - 1)], [0, 1], shape=(n, n)) / self.dx
+
+    def half(self, a):
+        """Restricts an array on the full grid to the solved part"""
+        return a[self.nx_full - self.nx:]
+
+    def full(self, a, parity=1):
+        """Extends an array on the solved part to the full grid"""
+        if not self.symmetric:
+            return a
+        return np.vstack((parity * np.flipud(a), a))
+
+    def edge_inverse(self, eps):
+        """Returns 1/eps averaged onto the x- and y-edges, including the PML stretch"""
+        inv = 1. / self.half(eps)
+        inv_x = 0.5 * (inv + np.vstack((inv[1:], inv[-1:])))
+        inv_y = 0.5 * (inv + np.hstack((inv[:, 1:], inv[:, -1:])))
+        return inv_x.ravel() / self.sxe, inv_y.ravel() / self.sye
+
+    def line_source(self, center, size):
+        """Returns the right hand side of a source of unit current density on the full grid"""
+        b = np.zeros((self.nx_full, self.ny), dtype=complex)
+        ix = np.where(np.abs(self.xs - center[0]) <= size[0] / 2. + 1e-9)[0]
+        iy = np.where(np.abs(self.ys - center[1]) <= size[1] / 2. + 1e-9)[0]
+        if not len(ix):
+            ix = [np.argmin(np.abs(self.xs - center[0]))]
+        if not len(iy):
+            iy = [np.argmin(np.abs(self.ys - center[1]))]
+        b[np.ix_(ix, iy)] = 1.
+        if size[0] == 0:
+            b /= self.dx
+        if size[1] == 0:
+            b /= self.dx
+        return -1j * self.omega * b
+
+    def operator(self, inv_x, inv_y):
+        return (self.dxb.dot(sp.diags(inv_x)).dot(self.dxf) +
+                self.dyb.dot(sp.diags(inv_y)).dot(self.dyf) +
+                np.square(self.omega) * sp.identity(self.nx * self.ny)).tocsc()
+
+    def set_base(self, eps):
+        """Factorizes the operator for a base permittivity, unless it is already factorized.
+        Without a fixed max_rank, the rank limit for low-rank updates is set from the
+        measured cost of a factorization relative to a single solve.
+        """
+        if self.lu is not None and np.array_equal(eps, self.base_eps):
+            return
+        self.base_eps = np.copy(eps)
+        self.base_x, self.base_y = self.edge_inverse(eps)
+        t0 = time.time()
+        self.lu = splu(self.operator(self.base_x, self.base_y))
+        t1 = time.time()
+        self.lu.solve(np.ones((self.nx * self.ny, 8), dtype=complex))
+        t2 = time.time()
+        if not self.fixed_rank:
+            self.max_rank = int(8 * (t1 - t0) / max(t2 - t1, 1e-9))
+
+    def solve(self, eps, b):
+        """Returns Hz on the full grid for the given permittivity and right hand side.
+        Designs close to the base are solved as low-rank updates of its factorization,
+        all others by a separate factorization that leaves the base untouched.
+        """
+        if self.lu is None:
+            self.set_base(eps)
+        b = self.half(b).ravel()
+        inv_x, inv_y = self.edge_inverse(eps)
+        ex = np.where(inv_x != self.base_x)[0]
+        ey = np.where(inv_y != self.base_y)[0]
+        if len(ex) + len(ey) > self.max_rank:
+            h = splu(self.operator(inv_x, inv_y)).solve(b)
+        elif not len(ex) + len(ey):
+            h = self.lu.solve(b)
+        else:
+            # A' = A + U C V with U = [dxb, dyb][:, e], C = diag(d(1/eps)), V = [dxf; dyf][e, :]
+            u = sp.hstack((self.dxb[:, ex], self.dyb[:, ey])).tocsc()
+            v = sp.vstack((self.dxf[ex], self.dyf[ey])).tocsr()
+            c = np.concatenate((inv_x[ex] - self.base_x[ex], inv_y[ey] - self.base_y[ey]))
+            h = self.lu.solve(b)
+            y = self.lu.solve(u.toarray())
+            k = np.diag(1. / c) + v.dot(y)
+            h = h - y.dot(np.linalg.solve(k, v.dot(h)))
+        return self.full(h.reshape(self.nx, self.ny))
+
+    def intensity_gradient(self, eps, h, ix, iy):
+        """Returns the derivative of the sum of |Ex|^2 over the full grid points np.ix_(ix, iy)
+        with respect to eps at every cell of the full grid, for the solution h of solve(eps, b).
+        Takes one solve of the transposed system, eps is factorized as base for it.
+        With symmetric, each derivative is the one of a cell without its mirror image.
+        """
+        hh = self.half(h).ravel()
+        inv_x, inv_y = self.edge_inverse(eps)
+        dxh, dyh = self.dxf.dot(hh), self.dyf.dot(hh)
+        # Ex at the selected points pulled back through the mirroring and the averaging onto the y-edges
+        q = np.zeros((self.nx_full, self.ny), dtype=complex)
+        q[np.ix_(ix, iy)] = self.get_field(h, eps, 'ex')[np.ix_(ix, iy)]
+        if self.symmetric:
+            q = q[self.nx:] + np.flipud(q[:self.nx])
+        q = np.conj(0.5 * (q + np.hstack((q[:, 1:], np.zeros((self.nx, 1)))))).ravel()
+        # Ex on the y-edges is i/w inv_y dyf h, its dependence on h through the adjoint field
+        self.set_base(eps)
+        lam = self.lu.solve(self.dyf.T.dot(1j / self.omega * inv_y * q), trans='T')
+        wx = -self.dxb.T.dot(lam) * dxh / self.sxe
+        wy = (1j / self.omega * q - self.dyb.T.dot(lam)) * dyh / self.sye
+        # transposed edge averages of 1/eps, see edge_inverse
+        wx, wy = wx.reshape(self.nx, self.ny), wy.reshape(self.nx, self.ny)
+        grad = 0.5 * (wx + wy)
+        grad[1:] += 0.5 * wx[:-1]
+        grad[-1] += 0.5 * wx[-1]
+        grad[:, 1:] += 0.5 * wy[:, :-1]
+        grad[:, -1] += 0.5 * wy[:, -1]
+        grad = -2 * np.real(grad) / np.square(self.half(eps))
+        if self.symmetric:
+            grad = grad / 2.
+        return self.full(grad)
+
+    def get_field(self, h, eps, component):
+        """Returns 'hz', 'ex', 'ey' or 'eps' on the cell centers of the full grid"""
+        if component == 'eps':
+            return eps
+        if component == 'hz':
+            return h
+        hh = self.half(h).ravel()
+        inv_x, inv_y = self.edge_inverse(eps)
+        if component == 'ex':
+            e = (1j / self.omega * inv_y * self.dyf.dot(hh)).reshape(self.nx, self.ny)
+            return self.full(0.5 * (e + np.hstack((np.zeros((self.nx, 1)), e[:, :-1]))))
+        if component == 'ey':
+            e = (-1j / self.omega * inv_x * self.dxf.dot(hh)).reshape(self.nx, self.ny)
+            return self.full(0.5 * (e + np.vstack((np.zeros((1, self.ny)), e[:-1]))), parity=-1)
+        raise ValueError('Unknown component {}'.format(component))
@@ -5,11 +5,9 @@ import meep as mp
 import numpy as np
 
 
-def make_geometry(design, xr, yr, width=None, height=None, spacing=0.0):
-    if not design.any():
-        return []
-
-    nx, ny = design.shape[0], design.shape[1]
+def pixel_grid(shape, xr, yr, width=None, height=None, spacing=0.0):
+    """Returns pixel center coordinates and pixel size of a design matrix"""
+    nx, ny = shape[0], shape[1]
     sx, sy = np.abs(xr[1] - xr[0]), np.abs(yr[1] - yr[0])
     cx, cy = np.mean(xr), np.mean(yr)
 
@@ -23,10 +21,74 @@ def make_geometry(design, xr, yr, width=None, height=None, spacing=0.0):
 
     x_range = np.linspace(cx - px * (nx - 1) / 2, cx + px * (nx - 1) / 2, nx)
     y_range = np.linspace(cy - py * (ny - 1) / 2, cy + py * (ny - 1) / 2, ny)
-    out = []
-    for i, j in np.transpose(np.where(design == 1)):
-        out.append([x_range[i], y_range[j], width, height])
-    return np.asarray(out)
+    return x_range, y_range, width, height
+
+
+def merge_pixels(design):
+    """Decomposes the set pixels of a design matrix into rectangles.
+    Runs along the first axis are merged with identical runs in neighbouring columns.
+    Returns the inclusive index ranges (i0, i1, j0, j1) of the rectangles.
+    """
+    edges = np.diff(np.pad(np.asarray(design) == 1, ((1, 1), (0, 0))).astype(np.int8), axis=0).T
+    # runs ordered by column, then by their start
+    j, i0 = np.nonzero(edges == 1)
+    i1 = np.nonzero(edges == -1)[1] - 1
+    order = np.lexsort((j, i1, i0))
+    j, i0, i1 = j[order], i0[order], i1[order]
+    first = np.ones(len(j), dtype=bool)
+    first[1:] = (i0[1:] != i0[:-1]) | (i1[1:] != i1[:-1]) | (j[1:] != j[:-1] + 1)
+    starts = np.nonzero(first)[0]
+    ends = np.append(starts, len(j))[1:] - 1
+    return np.column_stack((i0[starts], i1[starts], j[starts], j[ends]))
+
+
+def make_geometry(design, xr, yr, width=None, height=None, spacing=0.0):
+    """Returns center and size (cx, cy, w, h) of the blocks making up a design matrix.
+    Touching or overlapping pixels (spacing <= 0) are merged into rectangles covering the same area.
+    """
+    design = np.asarray(design)
+    if not design.any():
+        return []
+
+    x_range, y_range, width, height = pixel_grid(design.shape, xr, yr, width, height, spacing)
+    if spacing > 0:
+        i, j = np.nonzero(design == 1)
+        rects = np.column_stack((i, i, j, j))
+    else:
+        rects = merge_pixels(design)
+    i0, i1, j0, j1 = rects.T
+    return np.column_stack(((x_range[i0] + x_range[i1]) / 2., (y_range[j0] + y_range[j1]) / 2.,
+                            x_range[i1] - x_range[i0] + width, y_range[j1] - y_range[j0] + height))
+
+
+def pixel_index(shape, xr, yr, xs, ys, spacing=0.0):
+    """Returns the pixel indices of the grid points xs and ys and whether they lie inside that pixel"""
+    x_range, y_range, width, height = pixel_grid(shape, xr, yr, spacing=spacing)
+    px, py = width + spacing, height + spacing
+    ix = np.clip(np.round((xs - x_range[0]) / px).astype(int), 0, shape[0] - 1)
+    iy = np.clip(np.round((ys - y_range[0]) / py).astype(int), 0, shape[1] - 1)
+    inside_x = np.abs(xs - x_range[ix]) <= width / 2.
+    inside_y = np.abs(ys - y_range[iy]) <= height / 2.
+    return ix, iy, inside_x, inside_y
+
+
+def sample_design(design, xr, yr, xs, ys, spacing=0.0):
+    """Samples a design matrix at the grid points xs, ys, zero outside of all pixels"""
+    design = np.asarray(design)
+    ix, iy, inside_x, inside_y = pixel_index(design.shape, xr, yr, xs, ys, spacing)
+    return design[ix][:, iy] * inside_x[:, None] * inside_y[None, :]
+
+
+def rasterize_design(design, xr, yr, resolution, spacing=0.0):
+    """Samples a design matrix on a grid of the given resolution covering all pixels.
+    Returns the weights and the size of the covered region.
+    """
+    _, _, width, height = pixel_grid(design.shape, xr, yr, spacing=spacing)
+    size = ((width + spacing) * design.shape[0], (height + spacing) * design.shape[1])
+    nx, ny = int(np.ceil(size[0] * resolution)), int(np.ceil(size[1] * resolution))
+    xs = np.mean(xr) + (np.arange(nx) + 0.5) * size[0] / nx - size[0] / 2
+    ys = np.mean(yr) + (np.arange(ny) + 0.5) * size[1] / ny - size[1] / 2
+    return sample_design(design, xr, yr, xs, ys, spacing).astype(float), size
 
 
 def meep_from_design_rotate(design, xr, yr, eps, angle):
@@ -35,23 +97,26 @@ def meep_from_design_rotate(design, xr, yr, eps, angle):
     rad = np.deg2rad(angle)
     e1 = mp.Vector3(1, 0, 0).rotate(mp.Vector3(0, 0, 1), rad)
     e2 = mp.Vector3(0, 1, 0).rotate(mp.Vector3(0, 0, 1), rad)
+    material = mp.Medium(epsilon=eps)
     for cx, cy, w, h in geom:
         cxr, cyr, _ = mp.Vector3(cx, cy - 21).rotate(mp.Vector3(0, 0, 1), rad)
         cyr += 15
         out.append(mp.Block(size=mp.Vector3(w, h, 0),
                             center=mp.Vector3(cxr, cyr, 0),
                             e1=e1, e2=e2,
-                            material=mp.Medium(epsilon=eps)))
+                            material=material))
     return out
 
 
 def meep_from_design(design, xr, yr, eps, spacing):
     geom = make_geometry(design, xr, yr, spacing=spacing)
+    # one medium shared by all blocks
+    material = mp.Medium(epsilon=eps)
     out = []
     for cx, cy, w, h in geom:
         out.append(mp.Block(size=mp.Vector3(w, h, 0),
                             center=mp.Vector3(cx, cy, 0),
-                            material=mp.Medium(epsilon=eps)))
+                            material=material))
     return out
 
 
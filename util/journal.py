@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import pickle
+import queue
+import shutil
+import struct
+import threading
+import uuid
+import zlib
+import h5py
+import numpy as np
+from util.design import Design
+
+# size and crc32 of each log record
+RECORD = struct.Struct('<QI')
+
+
+class Journal(object):
+    """Append-only HDF5 output file of an optimization.
+    Per iteration records are appended to resizable, chunked and compressed datasets, designs are
+    stored as the bit-packed first matrix followed by the (i, j, value) flips between consecutive matrices.
+    All writes are done in order by a background thread. Existing files of the old format, with a
+    full 'design' dataset, are moved to fname + '.bak' and written anew.
+    The writes are appended to the log fname + '.journal', which is synced at every checkpoint, so that
+    a checkpoint costs only the records since the previous one. fname is replaced by an atomic rename of a
+    copy with the log applied, on close or when a log left by a crash is found. A crash thus loses the
+    records after the last checkpoint and leaves fname intact.
+    """
+    CHUNK = 256
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.log = fname + '.journal'
+        self.lengths = {}
+        self.offsets = []
+        self.last_design = None
+        self.error = None
+        self.queue = queue.Queue()
+        if os.path.exists(fname):
+            with h5py.File(fname, 'r') as h5f:
+                journal = 'journal' in h5f.attrs
+            if not journal:
+                os.replace(fname, fname + '.bak')
+        if not os.path.exists(fname) and os.path.exists(self.log):
+            # the log of a removed output file is discarded
+            os.remove(self.log)
+        if not os.path.exists(fname) or os.path.exists(self.log):
+            self.merge()
+        with h5py.File(fname, 'r') as h5f:
+            self.lengths = {k: len(v) for k, v in h5f.items() if isinstance(v, h5py.Dataset)}
+            if self.lengths.get('design_index'):
+                designs = read_designs(h5f)
+                self.offsets = list(designs.offsets)
+                self.last_design = designs[len(self.offsets) - 1]
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def load(fname):
+        """Returns all datasets of an output file as dict of lists, designs under 'design',
+        the state group as dict under 'state' (or None) and the sim group as dict under 'sim'.
+        The log of a running or crashed optimization is applied to an in-memory copy up to its last checkpoint.
+        """
+        data = {'state': None, 'sim': {}}
+        log = fname + '.journal'
+        if os.path.exists(log):
+            h5f = h5py.File(fname, 'r+', driver='core', backing_store=False)
+            replay(h5f, log)
+        else:
+            h5f = h5py.File(fname, 'r')
+        with h5f:
+            if 'state' in h5f:
+                data['state'] = {k: v[()] for k, v in h5f['state'].items()}
+            if 'sim' in h5f:
+                data['sim'] = {k: v[()] for k, v in h5f['sim'].items()}
+            for key, value in h5f.items():
+                if isinstance(value, h5py.Dataset) and not key.startswith('design_'):
+                    data[key] = list(value[()])
+            data['design'] = list(read_designs(h5f))
+        return data
+
+    def submit(self, *op):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(op)
+
+    def sync(self, name, values, item=None):
+        """Appends the entries of values not yet journaled to dataset name, or truncates it to len(values).
+        With item, only that element of each entry is stored.
+        """
+        n = self.lengths.get(name, 0)
+        if len(values) < n:
+            self.submit('truncate', name, len(values))
+        elif len(values) > n:
+            new = values[n:] if item is None else [v[item] for v in values[n:]]
+            self.submit('append', name, np.array(new))
+        self.lengths[name] = len(values)
+
+    def sync_designs(self, designs):
+        """Journals the flips of the designs appended since the last call, designs are never truncated"""
+        for design in designs[len(self.offsets):]:
+            design = np.asarray(design, dtype=np.uint8)
+            if self.last_design is None:
+                packed = Design(design)
+                self.submit('group', None, {'design_initial': packed.bits, 'design_shape': packed.shape})
+                flips = np.zeros((0, 3), dtype=np.uint16)
+                offset = 0
+            else:
+                idx = np.argwhere(design != self.last_design)
+                flips = np.column_stack((idx, design[tuple(idx.T)])).astype(np.uint16)
+                offset = self.offsets[-1] + len(flips)
+            self.submit('append', 'design_flips', flips)
+            self.submit('append', 'design_index', np.array([offset]))
+            self.offsets.append(offset)
+            self.last_design = design
+        self.lengths['design_index'] = len(self.offsets)
+        self.lengths['design_flips'] = self.offsets[-1] if self.offsets else 0
+
+    def write_group(self, name, arrays):
+        """Writes the given dict of arrays to group name, or to the root group for None"""
+        self.submit('group', name, as_arrays(arrays))
+
+    def checkpoint(self, state=None):
+        """Commits everything journaled so far and the optimizer state as state group to the log,
+        without state the optimization is recorded as finished
+        """
+        self.submit('checkpoint', 'state', None if state is None else as_arrays(state))
+
+    def close(self):
+        """Waits for all pending writes and applies the log to the output file"""
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        self.merge()
+
+    def merge(self):
+        """Replaces the output file with a copy that has the log applied up to its last checkpoint, removes the log"""
+        tmp = self.fname + '.tmp'
+        if os.path.exists(self.fname):
+            shutil.copyfile(self.fname, tmp)
+        with h5py.File(tmp, 'a' if os.path.exists(self.fname) else 'w') as h5f:
+            h5f.attrs['journal'] = 1
+            if os.path.exists(self.log):
+                replay(h5f, self.log)
+        with open(tmp, 'rb+') as f:
+            os.fsync(f.fileno())
+        os.replace(tmp, self.fname)
+        if os.path.exists(self.log):
+            os.remove(self.log)
+
+    def run(self):
+        with open(self.log, 'wb') as f:
+            append_record(f, ('log', uuid.uuid4().hex))
+            while True:
+                op = self.queue.get()
+                if op is None:
+                    break
+                if self.error is not None:
+                    continue
+                try:
+                    append_record(f, op)
+                    if op[0] == 'checkpoint':
+                        f.flush()
+                        os.fsync(f.fileno())
+                except Exception as e:
+                    self.error = e
+
+
+def as_arrays(values):
+    """Returns a dict with the values converted as HDF5 stores them, so the log depends on no other module"""
+    return {k: v if isinstance(v, str) else np.asarray(v) for k, v in values.items()}
+
+
+def append_record(f, op):
+    """Appends an operation to an open log"""
+    payload = pickle.dumps(op, protocol=pickle.HIGHEST_PROTOCOL)
+    f.write(RECORD.pack(len(payload), zlib.crc32(payload)) + payload)
+
+
+def read_log(log):
+    """Returns the id of a log and its operations up to the last checkpoint, a torn or corrupt tail is ignored"""
+    ops, committed = [], 0
+    with open(log, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        while f.tell() + RECORD.size <= size:
+            n, crc = RECORD.unpack(f.read(RECORD.size))
+            if f.tell() + n > size:
+                break
+            payload = f.read(n)
+            if zlib.crc32(payload) != crc:
+                break
+            ops.append(pickle.loads(payload))
+            if ops[-1][0] == 'checkpoint':
+                committed = len(ops)
+    if not ops or ops[0][0] != 'log':
+        return None, []
+    return ops[0][1], ops[1:committed]
+
+
+def replay(h5f, log):
+    """Applies the operations of a log up to its last checkpoint to an open output file.
+    The file records how many operations of which log it contains, so a log is never applied twice.
+    """
+    log_id, ops = read_log(log)
+    if log_id is None:
+        return
+    applied = h5f.attrs.get('log_applied', 0) if h5f.attrs.get('log_id') == log_id else 0
+    # only the state of the last checkpoint is written
+    last = max((k for k, op in enumerate(ops) if op[0] == 'checkpoint'), default=-1)
+    for k in range(applied, len(ops)):
+        if ops[k][0] != 'checkpoint' or k == last:
+            write(h5f, *ops[k])
+    h5f.attrs['log_id'] = log_id
+    h5f.attrs['log_applied'] = len(ops)
+
+
+def write(h5f, op, name=None, data=None):
+    """Applies a journaled operation to an open output file"""
+    if op == 'append':
+        if name not in h5f:
+            h5f.create_dataset(name, shape=(0,) + data.shape[1:], maxshape=(None,) + data.shape[1:],
+                               dtype=data.dtype, chunks=(Journal.CHUNK,) + data.shape[1:], compression='gzip')
+        dset = h5f[name]
+        n = len(dset)
+        dset.resize(n + len(data), axis=0)
+        dset[n:] = data
+    elif op == 'truncate':
+        h5f[name].resize(data, axis=0)
+    elif op == 'group':
+        grp = h5f if name is None else h5f.require_group(name)
+        for key, value in data.items():
+            # overwritten in place where shape and type allow, deleted objects leave unused space
+            if key in grp and grp[key].shape == np.shape(value) and grp[key].dtype == np.asarray(value).dtype:
+                grp[key][()] = value
+                continue
+            if key in grp:
+                del grp[key]
+            grp.create_dataset(key, data=value)
+    elif op == 'checkpoint':
+        if data is None:
+            if name in h5f:
+                del h5f[name]
+        else:
+            write(h5f, 'group', name, data)
+            for key in set(h5f[name]) - set(data):
+                del h5f[name][key]
+
+
+class DesignHistory(object):
+    """Sequence of the designs of an output file, reconstructed on demand from the journaled flips"""
+    def __init__(self, initial, flips, offsets):
+        self.initial = initial
+        self.flips = flips
+        self.offsets = offsets
+        self.cache = (0, initial)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return np.array([self[i] for i in range(*k.indices(len(self)))])
+        if k < 0:
+            k += len(self)
+        if not 0 <= k < len(self):
+            raise IndexError("design index out of range")
+        # continue from the last reconstructed design when going forward
+        start, design = self.cache if self.cache[0] <= k else (0, self.initial)
+        design = np.copy(design)
+        flips = self.flips[self.offsets[start]:self.offsets[k]]
+        # a pixel flipped in several steps takes the value of its last flip
+        _, last = np.unique(flips[::-1, :2], axis=0, return_index=True)
+        flips = flips[len(flips) - 1 - last]
+        design[flips[:, 0], flips[:, 1]] = flips[:, 2]
+        self.cache = (k, design)
+        return np.copy(design)
+
+    def __iter__(self):
+        for k in range(len(self)):
+            yield self[k]
+
+    def __array__(self, dtype=None, copy=None):
+        return np.array(self[:], dtype=dtype)
+
+
+def read_designs(h5f):
+    """Returns the designs of an open output file, indexable like the full 'design' dataset of older files"""
+    if 'design' in h5f:
+        return h5f['design'][()]
+    if 'design_initial' not in h5f:
+        return np.zeros((0,))
+    offsets = h5f['design_index'][()]
+    flips = h5f['design_flips'][:offsets[-1]]
+    initial = np.asarray(Design.from_bits(h5f['design_shape'][()], h5f['design_initial'][()]))
+    return DesignHistory(initial, flips, offsets)
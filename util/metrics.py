@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import meep as mp
+import numpy as np
+from util.peaks import half_max_width
+
+# width of the lateral slice the focus FWHM is measured on
+LATERAL_SX = 3.
+
+
+class Metric(object):
+    """Figure of merit of a finished run.
+    extent(bsw) returns the y-range it reads at full cell width, the simulation extracts
+    the union of the extents of all metrics once per run.
+    """
+    def __init__(self, name, func, extent):
+        self.name = name
+        self.func = func
+        self.extent = extent
+
+
+# registered metrics and objectives, metrics in the order of the metric vector
+METRICS = []
+OBJECTIVES = {}
+
+
+def focus_extent(bsw):
+    return min(bsw.focus_yr), max(bsw.focus_yr)
+
+
+def register(name, extent=focus_extent):
+    """Decorator registering func(bsw) as metric"""
+    def wrap(func):
+        METRICS.append(Metric(name, func, extent))
+        return func
+    return wrap
+
+
+def objective(name):
+    """Decorator registering func(values) as objective, values maps metric names to values"""
+    def wrap(func):
+        OBJECTIVES[name] = func
+        return func
+    return wrap
+
+
+def names():
+    return [m.name for m in METRICS]
+
+
+def compute(bsw):
+    """Returns the vector of all registered metrics of the last run of bsw"""
+    extents = np.array([m.extent(bsw) for m in METRICS])
+    bsw.set_focus_region((np.min(extents[:, 0]), np.max(extents[:, 1])))
+    return np.array([m.func(bsw) for m in METRICS], dtype=float)
+
+
+def loss(name, vector):
+    """Evaluates objective name on a metric vector"""
+    return float(OBJECTIVES[name](dict(zip(names(), vector))))
+
+
+@register('box_intensity', extent=lambda bsw: (min(bsw.focus_yr) - bsw.box_sy / 2., max(bsw.focus_yr) + bsw.box_sy / 2.))
+def box_intensity(bsw):
+    return np.square(np.linalg.norm(bsw.get_focus_box_field()))
+
+
+@register('lateral_fwhm')
+def lateral_fwhm(bsw):
+    return bsw.get_focus_width(sx=LATERAL_SX)[0]
+
+
+@register('axial_fwhm')
+def axial_fwhm(bsw):
+    yr = bsw.focus_yr
+    fy = bsw.get_focus_array(center=mp.Vector3(np.mean(bsw.focus_xr), np.mean(yr)),
+                             size=mp.Vector3(0, np.abs(yr[1] - yr[0])))
+    fy = np.square(np.abs(fy))
+    ys = (np.arange(fy.shape[0]) - (fy.shape[0] - 1) / 2.) / bsw.sim.resolution
+    return half_max_width(ys, fy)[0]
+
+
+@register('focal_y')
+def focal_y(bsw):
+    return np.mean(bsw.focus_yr) - bsw.get_focus_y()
+
+
+@register('side_lobe_ratio')
+def side_lobe_ratio(bsw):
+    """Highest intensity across the full cell width outside the main lobe relative to its peak"""
+    fy = bsw.get_focus_array(center=mp.Vector3(np.mean(bsw.focus_xr), focal_y(bsw)),
+                             size=mp.Vector3(bsw.sim.cell_size.x, 0))
+    fy = np.square(np.abs(fy))
+    p = np.argmax(fy)
+    # the main lobe ends at the first minimum on either side
+    rising = np.nonzero(np.diff(fy[p:]) > 0)[0]
+    falling = np.nonzero(np.diff(fy[:p + 1][::-1]) > 0)[0]
+    r = p + rising[0] if len(rising) else len(fy)
+    l = p - falling[0] if len(falling) else -1
+    outside = np.concatenate((fy[:max(l, 0)], fy[r + 1:]))
+    return np.max(outside) / fy[p] if len(outside) and fy[p] > 0 else 0.
+
+
+def inverse_square(width):
+    return 1. / np.square(width) if np.isfinite(width) and width > 0 else 0.
+
+
+@objective('field')
+def field_objective(values):
+    # max field loss. simple, effective.
+    return values['box_intensity']
+
+
+@objective('fwhm')
+def fwhm_objective(values):
+    return inverse_square(values['lateral_fwhm'])
+
+
+@objective('combined')
+def combined_objective(values):
+    # require a certain field strength, then optimize for fwhm
+    if values['box_intensity'] > 1:
+        return values['box_intensity'] + inverse_square(values['lateral_fwhm'])
+    return values['box_intensity']
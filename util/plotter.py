@@ -11,7 +11,7 @@ from datetime import datetime
 
 def plot_with_eps(bsw, xr=None, yr=None, interpolation='none', fname=None, savefig=''):
     cx = 0 if xr is None else np.mean(xr)
-    cy = 0 if yr is None else np.mean(yr)
+    cy = bsw.cell_center.y if yr is None else np.mean(yr)
     sx = bsw.sx if xr is None else np.abs(xr[1] - xr[0])
     sy = bsw.sy if yr is None else np.abs(yr[1] - yr[0])
     dim = (0, 0) if bsw.design_matrix is None else bsw.design_matrix.shape
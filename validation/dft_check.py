@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+import h5py
+import argparse
+import numpy as np
+from util.bswfocus import BSWFocus
+from util.journal import read_designs
+from util import metrics
+
+
+def run(d, design, **kwargs):
+    bsw = BSWFocus(**dict(d, **kwargs))
+    bsw.set_design(design)
+    start = time.time()
+    bsw.run()
+    values = metrics.compute(bsw)
+    return bsw, values, time.time() - start
+
+
+def main(args):
+    """Compares the metrics of the last design of an output file between complex fields
+    and real fields with DFT amplitudes
+    """
+    with h5py.File(args.file, 'r') as h5f:
+        d = {k: v[()] for k, v in h5f['sim'].items()}
+        design = read_designs(h5f)[-1]
+    d.update({'sim_resolution': args.res or d['sim_resolution'], 'solver': 'time'})
+
+    ref, ref_values, ref_time = run(d, design, use_complex=True, dft_region=None)
+    ref_field = np.abs(ref.get_focus_region().get_field(ref.field_component))
+    print('{:>16} {:>12} {:>12} {:>10}'.format('', 'complex', 'dft', 'rel. diff'))
+    for region in ('focus', 'cell'):
+        bsw, values, wall = run(d, design, dft_region=region, monitor=args.monitor)
+        field = np.abs(bsw.get_focus_region().get_field(bsw.field_component))
+        print('dft_region = {}'.format(region))
+        for name, a, b in zip(metrics.names(), ref_values, values):
+            print('{:>16} {:12.5g} {:12.5g} {:10.2e}'.format(name, a, b, np.abs(b - a) / max(np.abs(a), 1e-12)))
+        print('{:>16} {:12.5g} {:12.5g} {:10.2e}'.format('max |E|', np.max(ref_field), np.max(field),
+                                                        np.max(np.abs(field - ref_field)) / np.max(ref_field)))
+        print('{:>16} {:12.5g} {:12.5g}'.format('wall time', ref_time, wall))
+        print('{:>16} {:12d} {:12d}'.format('time steps', ref.sim.timestep(), bsw.sim.timestep()))
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+    p.add_argument('file', type=str, help="Optimization output file")
+    p.add_argument('--res', type=int, default=0, help="Simulation resolution (0 keeps the one of the file)")
+    p.add_argument('--monitor', type=str, default='focus', choices=['focus', 'extrapolate'],
+                   help="Steady state monitor of the DFT runs")
+    args = p.parse_args()
+    main(args)
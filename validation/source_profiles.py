@@ -9,6 +9,7 @@ import numpy as np
 from datetime import datetime
 from util.bswfocus import BSWFocus
 from util.geometry import meep_from_design_rotate
+from util.journal import read_designs
 import matplotlib.pyplot as plt
 
 
@@ -22,7 +23,7 @@ def main(args):
     res = 20
     h5f = h5py.File(args.file, 'r')
     d = {k: h5f['sim'][k].value for k in h5f['sim'].keys()}
-    m = np.array(h5f['design'])
+    m = read_designs(h5f)
     h5f.close()
     d.update({
         'sim_resolution': res,
@@ -37,7 +38,7 @@ def main(args):
     bsw.sources = [mp.Source(mp.ContinuousSource(wavelength=bsw.wavelength,
                                                  width=bsw.source_width),
                              component=mp.Hz,
-                             center=mp.Vector3(0, bsw.sy / 2),
+                             center=mp.Vector3(0, bsw.cell_center.y + bsw.sy / 2),
                              size=mp.Vector3(bsw.cell[0], 0),
                              amp_func=lambda x: gauss_beam(k, args.sigma, x))]
 
@@ -47,22 +48,22 @@ def main(args):
     h5f = h5py.File(loc.format(
         os.path.splitext(os.path.basename(args.file))[0],
         int(args.sigma)), 'w')
-    eps = bsw.sim.get_array(center=mp.Vector3(0, 0),
+    eps = bsw.sim.get_array(center=bsw.cell_center,
                             size=mp.Vector3(bsw.sx, bsw.sy),
                             component=mp.Dielectric)
     h5f['Dielectric'] = eps
 
-    ex = bsw.sim.get_array(center=mp.Vector3(0, 0),
+    ex = bsw.sim.get_array(center=bsw.cell_center,
                            size=mp.Vector3(bsw.sx, bsw.sy),
                            component=mp.Ex)
     h5f['Ex'] = ex
 
-    ey = bsw.sim.get_array(center=mp.Vector3(0, 0),
+    ey = bsw.sim.get_array(center=bsw.cell_center,
                            size=mp.Vector3(bsw.sx, bsw.sy),
                            component=mp.Ey)
     h5f['Ey'] = ey
 
-    hz = bsw.sim.get_array(center=mp.Vector3(0, 0),
+    hz = bsw.sim.get_array(center=bsw.cell_center,
                            size=mp.Vector3(bsw.sx, bsw.sy),
                            component=mp.Hz)
     h5f['Hz'] = hz